@@ -2,21 +2,33 @@
 # 日 期： 2023/12/12
 # app.py
 
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, stream_with_context
 from database_manager import DatabaseManager
+from db_pool import get_pool, pool_stats
 from apscheduler.schedulers.background import BackgroundScheduler
 import atexit
 from datetime import datetime, timedelta
 from data_fetcher import DataFetcher
-from main import load_config, get_vehicle_ids_by_city,get_id_order_model
+from main import load_config
 from route_matcher import RouteMatcher
 from task_manager import TaskManager
 from slope_cacu import SlopeCacu
 from road_conditon import RoadCondition
-import pandas as pd
+from elevation_store import ElevationStore
+from polyline_cache import PolylineCache
+from result_cache import ResultCache
+from vehicle_registry import VehicleRegistry
+from city_scheduler import CityScheduler, CityCostModel, count_routes
+from job_ledger import JobLedger
 from collections import defaultdict
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor, wait
+import heapq
 import json
 import re
+import io
+import csv
+import math
 from pypinyin import pinyin, Style
 
 app = Flask(__name__)
@@ -25,15 +37,51 @@ scheduler = BackgroundScheduler()
 #配置初始化
 config, db_config = load_config()
 
+#初始化数据库连接池，所有请求和定时任务共用
+get_pool(db_config, config.getint('database', 'pool_size', fallback=10))
+
 #高程图初始化加载
 
 with open('D:/Users/liuya/matchBusRoute/elevation_config.json', 'r', encoding='utf-8') as file:
     elevation_config = json.load(file)
 
-#加载每个城市的高程数据
-CITY_DATABASE = {}
-for city, info in elevation_config.items():
-    CITY_DATABASE[city] = pd.read_parquet(info['parquet_path'], columns=['经度', '纬度', '高程'])
+#各城市的高程数据在首次请求时加载，超出内存预算时释放最久未使用的城市
+CITY_DATABASE = ElevationStore(elevation_config, config.getfloat('elevation', 'memory_budget_mb', fallback=0))
+
+#预加载常用城市的高程数据
+prewarm_cities = [city.strip() for city in config.get('elevation', 'prewarm_cities', fallback='').split(',') if city.strip()]
+if prewarm_cities:
+    CITY_DATABASE.prewarm(prewarm_cities)
+
+#高德公交折线缓存，未配置缓存目录时不启用
+polyline_cache_dir = config.get('polyline_cache', 'cache_dir', fallback=None)
+POLYLINE_CACHE = PolylineCache(
+    polyline_cache_dir,
+    ttl_seconds=config.getfloat('polyline_cache', 'ttl_hours', fallback=168) * 3600,
+    stale_seconds=config.getfloat('polyline_cache', 'stale_hours', fallback=720) * 3600
+) if polyline_cache_dir else None
+
+#车辆清单索引，文件变化时自动重新加载
+VEHICLE_REGISTRY = VehicleRegistry(config['filepath']['excel_path'])
+
+#坡度计算结果缓存
+SLOPE_RESULT_CACHE = ResultCache(
+    max_entries=config.getint('slope_cache', 'max_entries', fallback=256),
+    disk_dir=config.get('slope_cache', 'disk_dir', fallback=None)
+)
+
+#多城市查询时并发查询各城市结果表的线程池及每个请求的查询截止时间（秒）
+CITY_QUERY_EXECUTOR = ThreadPoolExecutor(max_workers=config.getint('query', 'city_workers', fallback=4),
+                                         thread_name_prefix='city-query')
+CITY_QUERY_DEADLINE = config.getfloat('query', 'deadline_seconds', fallback=10)
+
+#定时任务各城市的耗时记录
+CITY_COST_MODEL = CityCostModel(config.get('task', 'cost_history_path', fallback=None))
+
+#定时任务台账，记录每辆车每天的处理状态，未配置时不启用
+ledger_path = config.get('task', 'ledger_path', fallback=None)
+JOB_LEDGER = JobLedger(ledger_path, max_attempts=config.getint('task', 'max_attempts', fallback=5),
+                       retry_backoff=config.getfloat('task', 'retry_backoff', fallback=60)) if ledger_path else None
 
 def scheduled_task():
     """
@@ -43,16 +91,20 @@ def scheduled_task():
     try:
         # config, db_config = load_config()
         data_fetcher = DataFetcher(config)
+        #清理超过保留期的本地轨迹
+        if data_fetcher.trajectory_store:
+            data_fetcher.trajectory_store.purge()
 
         #每次任务前先更新车辆信息
         # data_fetcher.fetch_and_save_vehicle_info()
+        VEHICLE_REGISTRY.refresh()
 
         # route_matcher = RouteMatcher(db_config)
         # task_manager = TaskManager(data_fetcher, route_matcher)
         # db_manager = DatabaseManager(db_config)
 
         # vehicle_ids = get_vehicle_ids(config['filepath']['excel_path'])
-        vehicle_ids_city = get_vehicle_ids_by_city(config['filepath']['excel_path'])
+        vehicle_ids_city = VEHICLE_REGISTRY.vin_city_map()
 
         # 设定结束时间为前一天的22:00
         end_time = datetime.now().replace(hour=22, minute=0, second=0, microsecond=0)- timedelta(days=1)
@@ -64,11 +116,23 @@ def scheduled_task():
         for vehicle_id, city in vehicle_ids_city.items():
             city_vehicle_ids[city].append(vehicle_id)
 
-        for city, vehicle_ids in city_vehicle_ids.items():
+        def run_city(city, vehicle_ids, match_workers, concurrency):
             db_manager = DatabaseManager(db_config, city)
-            route_matcher = RouteMatcher(db_config, city)
-            task_manager = TaskManager(data_fetcher, route_matcher)
-            task_manager.manage_tasks(vehicle_ids, start_time, end_time, db_manager, city)
+            route_matcher = RouteMatcher(db_config, city, config['filepath'].get('route_snapshot_dir'),
+                                         early_stop=config.getboolean('task', 'early_stop', fallback=False))
+            task_manager = TaskManager(data_fetcher, route_matcher, JOB_LEDGER)
+            return task_manager.manage_tasks(vehicle_ids, start_time, end_time, db_manager, city,
+                                             fetch_mode=config.get('task', 'fetch_mode', fallback='thread'),
+                                             concurrency=concurrency, match_workers=match_workers)
+
+        # 按预估耗时从大到小并行处理各城市，并记录实际耗时用于下次预估；
+        # 匹配进程数量和并发数量为所有城市合计，由调度器分配给同时执行的城市
+        city_scheduler = CityScheduler(run_city, CITY_COST_MODEL,
+                                       max_parallel=config.getint('task', 'city_concurrency', fallback=2),
+                                       route_counter=lambda city: count_routes(db_config, city),
+                                       match_workers=config.getint('task', 'match_workers', fallback=None),
+                                       concurrency=config.getint('task', 'concurrency', fallback=2))
+        city_scheduler.run(city_vehicle_ids)
         print("Scheduled task completed successfully.")
     except Exception as e:
         print(f"Error during scheduled task: {e}")
@@ -95,15 +159,7 @@ def get_match_results():
     per_page = int(request.args.get('per_page', 10))  # 每页显示的记录数，默认为10
 
     # 如果没有提供日期参数，则使用默认的日期范围
-    if not start_date or not end_date:
-        end_date = datetime.today().date()
-        start_date = end_date - timedelta(days=DEFAULT_DATE_RANGE)
-    else:
-        # 如果提供的日期是字符串，则进行转换
-        if isinstance(start_date, str):
-            start_date = datetime.strptime(start_date, '%Y-%m-%d').date()
-        if isinstance(end_date, str):
-            end_date = datetime.strptime(end_date, '%Y-%m-%d').date()
+    start_date, end_date = parse_date_range(start_date, end_date, DEFAULT_DATE_RANGE)
 
     # 校验日期范围
     if (end_date - start_date).days > MAX_DATE_RANGE:
@@ -116,75 +172,231 @@ def get_match_results():
         return jsonify({'status': 400, 'error': '至少填写1个查询条件'}), 400
 
     try:
-        vehicle_df = get_id_order_model(config['filepath']['excel_path'])
-
-        # 根据提供的参数进一步筛选数据集
-        vin_or_plate = request.args.get('vin')
-        # 根据VIN或车牌号进行筛选,支持模糊匹配
-        # if vin_or_plate:
-        #     vehicle_df = vehicle_df[(vehicle_df['VIN'] == vin_or_plate) | (vehicle_df['车牌'] == vin_or_plate)]
-        if vin_or_plate:
-            vehicle_df = vehicle_df[vehicle_df['VIN'].str.contains(vin_or_plate, na=False, case=False)
-                                    | vehicle_df['车牌'].str.contains(vin_or_plate, na=False, case=False)]
-        if 'model' in request.args:
-            vehicle_df = vehicle_df[vehicle_df['车型'] == request.args.get('model')]
-        if 'order' in request.args:
-            vehicle_df = vehicle_df[vehicle_df['订单号'] == int(request.args.get('order'))]
-        if 'customer' in request.args:
-            vehicle_df = vehicle_df[vehicle_df['购车客户'] == request.args.get('customer')]
-        if 'city' in request.args:
-            vehicle_df = vehicle_df[vehicle_df['所属区域'] == request.args.get('city')]
+        # 根据提供的参数在车辆清单索引中筛选车辆
+        # VIN或车牌号支持模糊匹配，其余条件精确匹配
+        vehicles = find_vehicles(request.args)
 
         # 如果筛选后没有任何记录，则返回错误
-        if vehicle_df.empty:
+        if not vehicles:
             # return jsonify({'error': '没有搜索到匹配车辆'}), 404
             return jsonify({'status': 404, 'error': '没有搜索到匹配车辆'}), 404
 
-        vins = vehicle_df['VIN'].tolist()
-        cities = vehicle_df['city'].tolist()
-        # results = db_manager.get_match_results(start_date=start_date, end_date=end_date, vins=vins)
         city_vehicle_ids = defaultdict(list)
-        for vin, city in zip(vins, cities):
-            city_vehicle_ids[city].append(vin)
-        results = []
-        for city, city_vins in city_vehicle_ids.items():
-            db_manager = DatabaseManager(db_config,city)
-            city_results = db_manager.get_match_results(start_date=start_date, end_date=end_date, vins=city_vins,city=city)
-            results.extend(city_results)
+        for vehicle in vehicles:
+            city_vehicle_ids[vehicle['city']].append(vehicle['VIN'])
+
+        # 按(date, vin)排序分页：传入cursor时从上一页最后一条之后查询，否则按页码跳过
+        cursor = request.args.get('cursor')
+        if cursor:
+            cursor_date, cursor_vin = cursor.split(',', 1)
+            after = (datetime.strptime(cursor_date, '%Y-%m-%d').date(), cursor_vin)
+            offset = 0
+        else:
+            after = None
+            offset = (page - 1) * per_page
 
-        total_counts = len(results)
+        # 只有一个城市时直接在SQL中跳过offset条，多个城市时每张表最多取offset+per_page条，归并后再截取当前页
+        single_city = len(city_vehicle_ids) == 1
+        skip = 0 if single_city else offset
 
-        if results:
-            results_df = pd.DataFrame(results)
-            results_df = results_df.rename(columns={'vin': 'VIN'})
+        def query_city(city, city_vins):
+            db_manager = DatabaseManager(db_config, city)
+            # 总数由各城市表的COUNT(*)相加得到，不再读取全部记录
+            count = db_manager.count_match_results(start_date=start_date, end_date=end_date, vins=city_vins, city=city)
+            rows = db_manager.get_match_results_page(start_date=start_date, end_date=end_date, vins=city_vins,
+                                                     city=city, limit=skip + per_page,
+                                                     offset=offset if single_city else 0, after=after)
+            return count, rows
+
+        city_results, failed_cities = query_cities(city_vehicle_ids, query_city)
+        if failed_cities and not city_results:
+            return jsonify({'status': 500, 'error': '查询匹配结果失败', 'failedcities': failed_cities}), 500
+
+        total_counts = sum(count for count, _ in city_results.values())
+        merged = heapq.merge(*(rows for _, rows in city_results.values()), key=lambda row: (row['date'], row['vin']))
+        paged_results = list(islice(merged, skip, skip + per_page))
+
+        if total_counts:
+            vehicle_by_vin = {vehicle['VIN']: vehicle for vehicle in vehicles}
+            final_json_list = []
+            for row in paged_results:
+                vehicle = vehicle_by_vin.get(row['vin'])
+                if vehicle is not None:
+                    final_json_list.append({**vehicle, **{key: value for key, value in row.items() if key != 'vin'}})
+
+            response = {'status': 200, 'data': final_json_list, 'totalcounts': total_counts}
+            # 部分城市查询失败或超时时返回已查到的结果，并列出失败的城市
+            if failed_cities:
+                response['failedcities'] = failed_cities
+            # 当前页已满时返回下一页的游标
+            if len(paged_results) == per_page:
+                last = paged_results[-1]
+                response['nextcursor'] = f"{last['date']},{last['vin']}"
+            return jsonify(response)
+        else:
+            empty_results = {'date': None, 'match_rate': None, 'matched_route': None, 'route_coverage': None}
+            response = {'status': 200, 'data': [{**vehicle, **empty_results} for vehicle in vehicles],
+                        'totalcounts': total_counts}
+            if failed_cities:
+                response['failedcities'] = failed_cities
+            return jsonify(response)
+    except Exception as e:
+        # return jsonify({'error': str(e)}), 500
+        return jsonify({'status': 500, 'error': str(e)}), 500
+
+def query_cities(city_vehicle_ids, query_city):
+    """
+    在线程池中并发查询各城市的结果表，整体不超过查询截止时间
+    :param city_vehicle_ids: 城市 -> VIN列表
+    :param query_city: 查询单个城市的函数，参数为(城市, VIN列表)
+    :return: (城市 -> 查询结果, 失败城市列表)
+    """
+    futures = {CITY_QUERY_EXECUTOR.submit(query_city, city, city_vins): city
+               for city, city_vins in city_vehicle_ids.items()}
+    done, not_done = wait(futures, timeout=CITY_QUERY_DEADLINE)
+
+    results = {}
+    failed_cities = []
+    for future in done:
+        city = futures[future]
+        try:
+            results[city] = future.result()
+        except Exception as e:
+            app.logger.error(f"Error querying match results of {city}: {e}")
+            failed_cities.append({'city': city, 'error': str(e)})
+    for future in not_done:
+        # 已开始执行的查询无法取消，结束后自动归还连接
+        future.cancel()
+        failed_cities.append({'city': futures[future], 'error': f'查询超过{CITY_QUERY_DEADLINE}秒未完成'})
+    return results, failed_cities
+
+
+def parse_date_range(start_date, end_date, default_days):
+    """
+    解析查询的日期范围，未同时提供起止日期时使用截至今天的默认天数
+    """
+    if not start_date or not end_date:
+        end_date = datetime.today().date()
+        return end_date - timedelta(days=default_days), end_date
+    # 如果提供的日期是字符串，则进行转换
+    if isinstance(start_date, str):
+        start_date = datetime.strptime(start_date, '%Y-%m-%d').date()
+    if isinstance(end_date, str):
+        end_date = datetime.strptime(end_date, '%Y-%m-%d').date()
+    return start_date, end_date
 
-            # total_counts = len(results_df)
 
-            # 分页查询
-            start = (page - 1) * per_page
-            end = start + per_page
-            paged_results_df = results_df.iloc[start:end]
+def find_vehicles(params):
+    """
+    根据查询参数在车辆清单索引中筛选车辆，VIN或车牌号支持模糊匹配，其余条件精确匹配
+    """
+    return VEHICLE_REGISTRY.find(
+        vin=params.get('vin'),
+        model=params.get('model'),
+        order=int(params.get('order')) if params.get('order') else None,
+        customer=params.get('customer'),
+        region=params.get('city')
+    )
+
+
+#批量导出匹配结果的路由
+@app.route('/matchresults/export', methods=['GET', 'POST'])
+def export_match_results():
+    """
+    以NDJSON或CSV格式流式导出匹配结果及车辆信息，查询条件与/matchresults相同，
+    POST时可在json请求体中通过vins指定VIN列表。结果按城市依次从数据库游标中分批读取并分块返回
+    :return:
+    """
+    DEFAULT_DATE_RANGE = 30  # 天
+    MAX_DATE_RANGE = config.getint('export', 'max_date_range', fallback=366)  # 天
+    CHUNK_SIZE = config.getint('export', 'chunk_size', fallback=1000)  # 每次读取和发送的行数
+
+    params = request.args.to_dict()
+    vin_list = None
+    if request.method == 'POST':
+        body = request.get_json(silent=True) or {}
+        params.update({key: value for key, value in body.items() if key != 'vins'})
+        vin_list = body.get('vins')
+        if vin_list is not None and not isinstance(vin_list, list):
+            return jsonify({'status': 400, 'error': 'vins必须是VIN列表'}), 400
+
+    export_format = params.get('format', 'ndjson').lower()
+    if export_format not in ('ndjson', 'csv'):
+        return jsonify({'status': 400, 'error': '导出格式只支持ndjson或csv'}), 400
+
+    start_date, end_date = parse_date_range(params.get('start_date'), params.get('end_date'), DEFAULT_DATE_RANGE)
+    if (end_date - start_date).days > MAX_DATE_RANGE:
+        return jsonify({'status': 400, 'error': f'导出时间范围不能超过{MAX_DATE_RANGE}天'}), 400
 
-            final_df = pd.merge(
-                vehicle_df,
-                paged_results_df,
-                on='VIN',
-                how='inner'
-            )
+    if not vin_list and not any([params.get(param) for param in ['vin', 'model', 'order', 'customer', 'city']]):
+        return jsonify({'status': 400, 'error': '至少填写1个查询条件'}), 400
 
-            final_json_list = final_df.to_dict(orient='records')
-            return jsonify({'status': 200, 'data': final_json_list, 'totalcounts': total_counts})
-        else:
-            filtered_vehicle_df = vehicle_df.copy()
-            filtered_vehicle_df['date'] = pd.NA
-            filtered_vehicle_df['match_rate'] = pd.NA
-            filtered_vehicle_df['matched_route'] = pd.NA
-            filtered_vehicle_df['route_coverage'] = pd.NA
-            return jsonify({'status': 200, 'data': filtered_vehicle_df.to_dict(orient='records'), 'totalcounts': total_counts})
+    try:
+        vehicles = find_vehicles(params)
+        if vin_list:
+            vin_set = set(vin_list)
+            vehicles = [vehicle for vehicle in vehicles if vehicle['VIN'] in vin_set]
     except Exception as e:
-        # return jsonify({'error': str(e)}), 500
         return jsonify({'status': 500, 'error': str(e)}), 500
 
+    if not vehicles:
+        return jsonify({'status': 404, 'error': '没有搜索到匹配车辆'}), 404
+
+    # 车辆清单中的空值为NaN，导出时统一为空
+    vehicle_by_vin = {vehicle['VIN']: {key: None if isinstance(value, float) and math.isnan(value) else value
+                                       for key, value in vehicle.items()}
+                      for vehicle in vehicles}
+    city_vehicle_ids = defaultdict(list)
+    for vehicle in vehicles:
+        city_vehicle_ids[vehicle['city']].append(vehicle['VIN'])
+
+    def export_rows():
+        for city, city_vins in city_vehicle_ids.items():
+            db_manager = DatabaseManager(db_config, city)
+            for row in db_manager.iter_match_results(start_date=start_date, end_date=end_date,
+                                                     vins=city_vins, city=city, chunk_size=CHUNK_SIZE):
+                vehicle = vehicle_by_vin.get(row['vin'])
+                if vehicle is not None:
+                    yield {**vehicle, **{key: value for key, value in row.items() if key != 'vin'}}
+
+    def generate():
+        lines = []
+        header = None
+        try:
+            for record in export_rows():
+                if export_format == 'csv':
+                    if header is None:
+                        header = list(record)
+                        lines.append(csv_line(header))
+                    lines.append(csv_line([record.get(column) for column in header]))
+                else:
+                    lines.append(json.dumps(record, ensure_ascii=False, default=str) + '\n')
+                if len(lines) >= CHUNK_SIZE:
+                    yield ''.join(lines)
+                    lines = []
+        except Exception as e:
+            # 响应已经开始发送，重新抛出异常使分块传输异常中断，不发送结束标记，
+            # 客户端可以发现文件不完整；缓存中未发送的行也不再发送
+            app.logger.error(f"Error exporting match results: {e}")
+            raise
+        if lines:
+            yield ''.join(lines)
+
+    mimetype = 'text/csv' if export_format == 'csv' else 'application/x-ndjson'
+    response = Response(stream_with_context(generate()), mimetype=mimetype)
+    response.headers['Content-Disposition'] = f'attachment; filename=match_results.{export_format}'
+    return response
+
+
+def csv_line(values):
+    """
+    将一行数据格式化为CSV文本
+    """
+    buffer = io.StringIO()
+    csv.writer(buffer).writerow(['' if value is None else value for value in values])
+    return buffer.getvalue()
+
+
 #请求坡度计算的路由
 @app.route('/calculateslope', methods=['GET'])
 def calculate_slope():
@@ -203,16 +415,16 @@ def calculate_slope():
         return jsonify({'status': 400,'error': 'Route name is required'}), 400
 
     try:
-        slopecacu = SlopeCacu(config, db_config,CITY_DATABASE[city_name])
+        slopecacu = SlopeCacu(config, db_config,CITY_DATABASE[city_name],POLYLINE_CACHE,SLOPE_RESULT_CACHE)
         slope_results = slopecacu.process_route(chinese_to_pinyin(extract_city(city_name)),route_name)
 
         # 格式化结果
         formatted_results = []
-        for slope_tuple in slope_results:
+        for segment in slope_results:
             slope_info = {
-                "gradient": slope_tuple[0].split(":")[1],
-                "distance": slope_tuple[1].split(":")[1],
-                "gps": slope_tuple[2].split(":")[1]
+                "gradient": str(segment.gradient),
+                "distance": str(segment.distance),
+                "gps": f"{segment.lng},{segment.lat}"
             }
             formatted_results.append(slope_info)
 
@@ -244,7 +456,7 @@ def road_condition():
         return jsonify({'status': 400,'error': 'Route name is required'}), 400
 
     try:
-        roadcondition = RoadCondition(config, db_config,CITY_DATABASE[city_name])
+        roadcondition = RoadCondition(config, db_config,CITY_DATABASE[city_name],POLYLINE_CACHE)
         lngArr, latArr = roadcondition.get_line_GPS(chinese_to_pinyin(extract_city(city_name)),route_name)
         via_stations = roadcondition.get_route_data(route_name,chinese_to_pinyin(extract_city(city_name)))
 
@@ -265,6 +477,41 @@ def road_condition():
         app.logger.error(f"Error get roadcondition: {e}")
         return jsonify({'status': 500, 'error': str(e)}), 500
 
+#查询缓存、高程数据加载和数据库连接池使用情况的路由
+@app.route('/stats', methods=['GET'])
+def stats():
+    return jsonify({
+        'status': 200,
+        'data': {
+            'slope_cache': SLOPE_RESULT_CACHE.stats(),
+            'elevation': CITY_DATABASE.stats(),
+            'db_pool': pool_stats()
+        }
+    })
+
+#清除公交折线缓存的路由，路线调整后调用
+@app.route('/polylinecache/invalidate', methods=['POST'])
+def invalidate_polyline_cache():
+    city_name = request.args.get('city')
+    route_name = request.args.get('route_name')
+
+    if POLYLINE_CACHE is None:
+        return jsonify({'status': 400, 'error': '未启用折线缓存'}), 400
+
+    # 只允许清除已录入城市的缓存，城市名称会拼接为缓存目录
+    if city_name and city_name not in CITY_DATABASE:
+        return jsonify({'status': 400, 'error': '该地区暂未录入高程库'}), 400
+
+    try:
+        city = chinese_to_pinyin(extract_city(city_name)) if city_name else None
+        removed = POLYLINE_CACHE.invalidate(city, route_name)
+        return jsonify({'status': 200, 'data': {'removed': removed}})
+    except ValueError as e:
+        return jsonify({'status': 400, 'error': str(e)}), 400
+    except Exception as e:
+        app.logger.error(f"Error invalidating polyline cache: {e}")
+        return jsonify({'status': 500, 'error': str(e)}), 500
+
 def extract_city(region_name):
     # 处理特殊行政单位和直辖市
     special_cases = ["北京市", "天津市", "上海市", "重庆市"]
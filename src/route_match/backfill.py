@@ -0,0 +1,169 @@
+# backfill.py
+# 补跑历史匹配结果：python backfill.py --start 2024-04-01 --end 2024-04-30 --city chongqing [--vin LJSKB8KX]
+
+import time
+import argparse
+import threading
+from collections import defaultdict
+from datetime import datetime, timedelta
+from main import load_config
+from data_fetcher import DataFetcher
+from route_matcher import RouteMatcher
+from match_pipeline import MatchPipeline
+from database_manager import DatabaseManager, MatchResultWriter
+from vehicle_registry import VehicleRegistry
+from job_ledger import JobLedger
+
+#进度输出间隔（秒）
+PROGRESS_INTERVAL = 30
+
+
+class BackfillProgress:
+    """
+    补跑进度统计，按固定间隔输出完成数量、吞吐量和预计剩余时间
+    """
+    def __init__(self, total, interval=PROGRESS_INTERVAL):
+        self.total = total
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.start = time.perf_counter()
+        self.last_report = self.start
+        self.done = 0
+        self.matched = 0
+        self.failed = 0
+
+    def update(self, matched=False, failed=False):
+        with self.lock:
+            self.done += 1
+            self.matched += matched
+            self.failed += failed
+            now = time.perf_counter()
+            if now - self.last_report >= self.interval:
+                self.last_report = now
+                self.report(now)
+
+    def report(self, now=None):
+        elapsed = (now or time.perf_counter()) - self.start
+        rate = self.done / elapsed if elapsed > 0 else 0
+        remaining = (self.total - self.done) / rate if rate > 0 else 0
+        print(f"进度：{self.done}/{self.total}，匹配{self.matched}，失败{self.failed}，"
+              f"{rate:.1f}车日/秒，已用{elapsed:.0f}秒，预计剩余{remaining:.0f}秒")
+
+
+def day_windows(start_date, end_date, start_hour=8, end_hour=22):
+    """
+    :return: 每天的(开始时间, 结束时间)，与定时任务的时间段一致
+    """
+    day = start_date
+    while day <= end_date:
+        base = datetime.combine(day, datetime.min.time())
+        yield base.replace(hour=start_hour), base.replace(hour=end_hour)
+        day += timedelta(days=1)
+
+
+def backfill(config, db_config, city, start_date, end_date, vehicle_ids, fetch_workers=8, match_workers=None,
+             batch_size=500, ledger=None, start_hour=8, end_hour=22, early_stop=False):
+    """
+    补跑一个城市在日期范围内的匹配结果：线路模型只加载一次，所有(车辆, 日期)通过同一条流水线获取和匹配
+    :param ledger: JobLedger，提供时跳过已完成的(车辆, 日期)，可中断后继续
+    :param early_stop: 使用流式匹配，最佳路线确定后提前结束
+    :return: 成功写入的结果数量
+    """
+    route_matcher = RouteMatcher(db_config, city, config['filepath'].get('route_snapshot_dir'), early_stop=early_stop)
+    data_fetcher = DataFetcher(config)
+    if data_fetcher.trajectory_store:
+        data_fetcher.trajectory_store.purge()
+    db_manager = DatabaseManager(db_config, city)
+
+    def on_written(rows):
+        if ledger:
+            vins_by_day = defaultdict(list)
+            for row in rows:
+                vins_by_day[row[4]].append(row[0])
+            for day, vins in vins_by_day.items():
+                ledger.mark_written(city, day, vins)
+
+    def on_write_failed(rows):
+        if ledger:
+            for row in rows:
+                ledger.mark_failed(city, row[4], row[0], "写入数据库失败")
+
+    with MatchResultWriter(db_manager, city, batch_size, on_written=on_written, on_failed=on_write_failed) as writer:
+        tasks = []
+        for start_time, end_time in day_windows(start_date, end_date, start_hour, end_hour):
+            day_vehicle_ids = vehicle_ids
+            if ledger:
+                day_vehicle_ids, unwritten = ledger.prepare(city, start_time.date(), vehicle_ids)
+                for route_request in unwritten:
+                    writer.add(*route_request, start_time.date())
+            tasks.extend((vin, start_time, end_time) for vin in day_vehicle_ids)
+
+        print(f"{city} {start_date}至{end_date}：{len(vehicle_ids)}辆车，待处理{len(tasks)}车日")
+        progress = BackfillProgress(len(tasks))
+
+        def on_result(task, matched):
+            vin, start_time, _ = task
+            day = start_time.date()
+            route_request = (vin,) + matched if matched else None
+            if ledger:
+                ledger.mark_matched(city, day, vin, route_request)
+            if route_request:
+                writer.add(*route_request, day)
+            progress.update(matched=route_request is not None)
+
+        def on_error(task, error):
+            vin, start_time, _ = task
+            print(f"在处理 {vin} {start_time.date()} 时发生错误: {error}")
+            if ledger:
+                ledger.mark_failed(city, start_time.date(), vin, error)
+            progress.update(failed=True)
+
+        def on_fetched(task):
+            if ledger:
+                ledger.mark_fetched(city, task[1].date(), task[0])
+
+        pipeline = MatchPipeline(data_fetcher, route_matcher, fetch_workers=fetch_workers,
+                                 match_workers=match_workers, city=city)
+        pipeline.run(tasks, on_result, on_error=on_error, on_fetched=on_fetched)
+        writer.flush()
+        progress.report()
+        return writer.written
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="补跑指定日期范围内的路线匹配结果")
+    parser.add_argument('--start', required=True, help="开始日期，格式YYYY-MM-DD")
+    parser.add_argument('--end', required=True, help="结束日期（包含），格式YYYY-MM-DD")
+    parser.add_argument('--city', required=True, help="城市拼音，如yangzhou")
+    parser.add_argument('--vin', help="VIN或车牌，模糊匹配")
+    parser.add_argument('--vins', help="逗号分隔的VIN列表")
+    parser.add_argument('--fetch-workers', type=int, default=8, help="获取数据的线程数量")
+    parser.add_argument('--match-workers', type=int, default=None, help="匹配进程数量，默认为CPU核数")
+    parser.add_argument('--batch-size', type=int, default=500, help="每批写入数据库的结果数量")
+    parser.add_argument('--ledger', help="台账文件路径，提供时可中断后继续")
+    parser.add_argument('--early-stop', action='store_true', help="最佳路线确定后提前结束匹配")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    config, db_config = load_config()
+
+    start_date = datetime.strptime(args.start, '%Y-%m-%d').date()
+    end_date = datetime.strptime(args.end, '%Y-%m-%d').date()
+    if end_date < start_date:
+        raise SystemExit("结束日期不能早于开始日期")
+
+    registry = VehicleRegistry(config['filepath']['excel_path'])
+    vehicle_ids = [vehicle['VIN'] for vehicle in registry.find(vin=args.vin, city=args.city)]
+    if args.vins:
+        selected = {vin.strip() for vin in args.vins.split(',') if vin.strip()}
+        vehicle_ids = [vin for vin in vehicle_ids if vin in selected]
+    if not vehicle_ids:
+        raise SystemExit("没有搜索到匹配车辆")
+
+    ledger = JobLedger(args.ledger) if args.ledger else None
+    written = backfill(config, db_config, args.city, start_date, end_date, vehicle_ids,
+                       fetch_workers=args.fetch_workers, match_workers=args.match_workers,
+                       batch_size=args.batch_size, ledger=ledger, early_stop=args.early_stop)
+    print(f"补跑完成，写入{written}条匹配结果")
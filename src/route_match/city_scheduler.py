@@ -0,0 +1,177 @@
+import os
+import json
+import time
+import threading
+from statistics import median
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from db_pool import get_pool
+
+#没有任何历史记录时，每辆车的预估耗时（秒）
+DEFAULT_SECONDS_PER_VIN = 1.0
+#线路数量的参考值，用于按线路模型大小换算没有历史记录的城市的耗时
+ROUTES_REFERENCE = 100
+#每辆车耗时的指数平滑系数，越大越偏向最近一次的结果
+COST_SMOOTHING = 0.5
+
+
+def count_routes(db_config, city):
+    """
+    获取城市的线路数量，作为线路模型大小
+    """
+    table_name = "bus_routes" if city.lower() == "yangzhou" else f"bus_routes_{city.lower()}"
+    with get_pool(db_config).get_connection() as cnx:
+        with cnx.cursor() as cursor:
+            cursor.execute(f"SELECT COUNT(*) FROM {table_name}")
+            return cursor.fetchone()[0]
+
+
+class CityCostModel:
+    """
+    各城市匹配任务的耗时模型：按车辆数和线路数量预估耗时，每次运行后记录实际耗时并保存，预估逐次修正
+    """
+    def __init__(self, history_path=None):
+        self.history_path = history_path
+        self.lock = threading.Lock()
+        self.history = {}
+        if history_path and os.path.exists(history_path):
+            try:
+                with open(history_path, 'r', encoding='utf-8') as f:
+                    self.history = json.load(f)
+            except (OSError, ValueError) as e:
+                print(f"读取城市耗时记录失败：{history_path}: {e}")
+
+    @staticmethod
+    def route_factor(routes):
+        return 1 + (routes or 0) / ROUTES_REFERENCE
+
+    def estimate(self, city, vin_count, routes):
+        """
+        预估城市的耗时（秒）。有历史记录的城市使用其每辆车的平均耗时，
+        没有的按其他城市换算到单位线路规模后的耗时中位数和本城市的线路数量估算
+        """
+        with self.lock:
+            record = self.history.get(city)
+            if record:
+                return vin_count * record['seconds_per_vin']
+            normalized = [item['seconds_per_vin'] / self.route_factor(item.get('routes'))
+                          for item in self.history.values()]
+        base = median(normalized) if normalized else DEFAULT_SECONDS_PER_VIN
+        return vin_count * base * self.route_factor(routes)
+
+    def record(self, city, vin_count, routes, wall_time):
+        """
+        记录城市本次的实际耗时
+        """
+        if vin_count <= 0:
+            return
+        seconds_per_vin = wall_time / vin_count
+        with self.lock:
+            record = self.history.get(city)
+            if record:
+                seconds_per_vin = COST_SMOOTHING * seconds_per_vin + (1 - COST_SMOOTHING) * record['seconds_per_vin']
+            self.history[city] = {
+                'seconds_per_vin': seconds_per_vin,
+                'routes': routes,
+                'vins': vin_count,
+                'wall_time': wall_time,
+                'updated_at': time.strftime('%Y-%m-%d %H:%M:%S')
+            }
+        self.save()
+
+    def save(self):
+        if not self.history_path:
+            return
+        with self.lock:
+            data = json.dumps(self.history, ensure_ascii=False, indent=2)
+        tmp_path = f"{self.history_path}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(data)
+            os.replace(tmp_path, self.history_path)
+        except OSError as e:
+            print(f"保存城市耗时记录失败：{self.history_path}: {e}")
+
+
+class CityScheduler:
+    """
+    多城市定时任务调度：按预估耗时从大到小启动，在并发城市数量的限制内并行执行。
+    匹配进程数量和获取数据的并发数量是所有城市共用的总量，平均分配给同时执行的城市
+    """
+    def __init__(self, run_city, cost_model, max_parallel=2, route_counter=None, match_workers=None, concurrency=2):
+        """
+        :param run_city: 执行单个城市任务的函数，参数为(城市, VIN列表, 匹配进程数量, 获取数据的并发数量)
+        :param cost_model: CityCostModel
+        :param max_parallel: 同时执行的城市数量上限
+        :param route_counter: 获取城市线路数量的函数，参数为城市，未提供时按0计算
+        :param match_workers: 所有城市合计的匹配进程数量，默认为CPU核数
+        :param concurrency: 所有城市合计的获取数据线程数量或异步请求并发数量
+        """
+        self.run_city = run_city
+        self.cost_model = cost_model
+        self.max_parallel = max_parallel
+        self.route_counter = route_counter
+        self.match_workers = match_workers or os.cpu_count() or 1
+        self.concurrency = concurrency
+
+    def get_routes(self, city):
+        if self.route_counter is None:
+            return 0
+        try:
+            return self.route_counter(city)
+        except Exception as e:
+            print(f"获取 {city} 的线路数量失败: {e}")
+            return 0
+
+    def plan(self, city_vehicle_ids):
+        """
+        :return: 按预估耗时从大到小排列的(城市, VIN列表, 线路数量, 预估耗时)
+        """
+        plan = []
+        for city, vehicle_ids in city_vehicle_ids.items():
+            routes = self.get_routes(city)
+            plan.append((city, vehicle_ids, routes, self.cost_model.estimate(city, len(vehicle_ids), routes)))
+        plan.sort(key=lambda item: item[3], reverse=True)
+        return plan
+
+    def city_budget(self, city_count):
+        """
+        每个城市可以使用的匹配进程数量和获取数据的并发数量，同时执行的城市合计不超过总量
+        :return: (匹配进程数量, 并发数量)
+        """
+        parallel = max(1, min(self.max_parallel, city_count))
+        return max(1, self.match_workers // parallel), max(1, self.concurrency // parallel)
+
+    def run_one(self, city, vehicle_ids, routes, budget):
+        start = time.perf_counter()
+        result = self.run_city(city, vehicle_ids, *budget)
+        wall_time = time.perf_counter() - start
+        self.cost_model.record(city, len(vehicle_ids), routes, wall_time)
+        return result, wall_time
+
+    def run(self, city_vehicle_ids):
+        """
+        执行所有城市的任务，单个城市失败不影响其他城市
+        :param city_vehicle_ids: 城市 -> VIN列表
+        :return: 城市 -> {'estimate', 'wall_time', 'result'或'error'}
+        """
+        plan = self.plan(city_vehicle_ids)
+        for city, vehicle_ids, routes, estimate in plan:
+            print(f"城市 {city}：{len(vehicle_ids)}辆车，{routes}条线路，预估耗时{estimate:.0f}秒")
+        budget = self.city_budget(len(plan))
+        print(f"每个城市使用{budget[0]}个匹配进程，获取数据并发数量{budget[1]}")
+
+        summary = {}
+        # 线程池按提交顺序取任务，耗时最长的城市最先开始
+        with ThreadPoolExecutor(max_workers=self.max_parallel, thread_name_prefix='city-task') as executor:
+            futures = {executor.submit(self.run_one, city, vehicle_ids, routes, budget): (city, estimate)
+                       for city, vehicle_ids, routes, estimate in plan}
+            for future in as_completed(futures):
+                city, estimate = futures[future]
+                try:
+                    result, wall_time = future.result()
+                    summary[city] = {'estimate': estimate, 'wall_time': wall_time, 'result': result}
+                    print(f"城市 {city} 完成，耗时{wall_time:.0f}秒（预估{estimate:.0f}秒）")
+                except Exception as e:
+                    summary[city] = {'estimate': estimate, 'error': str(e)}
+                    print(f"城市 {city} 的任务失败: {e}")
+        return summary
@@ -0,0 +1,65 @@
+import numpy as np
+
+# 与eviltransform保持一致的参数
+EARTH_R = 6378137.0
+EE = 0.00669342162296594323
+
+
+def out_of_china(lat, lng):
+    """
+    判断坐标是否在中国范围外，范围外的坐标不做偏移
+    """
+    return ~((lng >= 72.004) & (lng <= 137.8347) & (lat >= 0.8293) & (lat <= 55.8271))
+
+
+def _transform(x, y):
+    xy = x * y
+    abs_x = np.sqrt(np.abs(x))
+    x_pi = x * np.pi
+    y_pi = y * np.pi
+    d = 20.0 * np.sin(6.0 * x_pi) + 20.0 * np.sin(2.0 * x_pi)
+
+    lat = d
+    lng = d
+
+    lat = lat + 20.0 * np.sin(y_pi) + 40.0 * np.sin(y_pi / 3.0)
+    lng = lng + 20.0 * np.sin(x_pi) + 40.0 * np.sin(x_pi / 3.0)
+
+    lat = lat + 160.0 * np.sin(y_pi / 12.0) + 320 * np.sin(y_pi / 30.0)
+    lng = lng + 150.0 * np.sin(x_pi / 12.0) + 300.0 * np.sin(x_pi / 30.0)
+
+    lat = lat * (2.0 / 3.0)
+    lng = lng * (2.0 / 3.0)
+
+    lat = lat + (-100.0 + 2.0 * x + 3.0 * y + 0.2 * y * y + 0.1 * xy + 0.2 * abs_x)
+    lng = lng + (300.0 + x + 2.0 * y + 0.1 * x * x + 0.1 * xy + 0.1 * abs_x)
+
+    return lat, lng
+
+
+def _delta(lat, lng):
+    d_lat, d_lng = _transform(lng - 105.0, lat - 35.0)
+    rad_lat = lat / 180.0 * np.pi
+    magic = np.sin(rad_lat)
+    magic = 1 - EE * magic * magic
+    sqrt_magic = np.sqrt(magic)
+    d_lat = (d_lat * 180.0) / ((EARTH_R * (1 - EE)) / (magic * sqrt_magic) * np.pi)
+    d_lng = (d_lng * 180.0) / (EARTH_R / sqrt_magic * np.cos(rad_lat) * np.pi)
+    return d_lat, d_lng
+
+
+def wgs2gcj_arrays(wgs_lat, wgs_lng):
+    """
+    批量将WGS84坐标转换为GCJ-02坐标，算法与eviltransform.wgs2gcj一致
+    :param wgs_lat: 纬度数组
+    :param wgs_lng: 经度数组
+    :return: (gcj_lat, gcj_lng) 两个float64数组
+    """
+    wgs_lat = np.asarray(wgs_lat, dtype=np.float64)
+    wgs_lng = np.asarray(wgs_lng, dtype=np.float64)
+    d_lat, d_lng = _delta(wgs_lat, wgs_lng)
+    outside = out_of_china(wgs_lat, wgs_lng)
+    gcj_lat = np.where(outside, wgs_lat, wgs_lat + d_lat)
+    gcj_lng = np.where(outside, wgs_lng, wgs_lng + d_lng)
+    return gcj_lat, gcj_lng
+
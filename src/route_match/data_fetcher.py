@@ -1,75 +1,56 @@
 # 作 者： Liuyaoqiu
 # 日 期： 2023/12/4
 import time
-import requests
+import asyncio
 import pandas as pd
 import json
+from sdk_client import SdkClient, RETRY_STATUS
+from trajectory_store import TrajectoryStore, DEFAULT_RETENTION_DAYS
+
+
+class FetchError(Exception):
+    """
+    车辆历史数据获取失败
+    """
+
 
 class DataFetcher:
     def __init__(self, config):
         self.config = config
-        self.authorization = self.get_authorization()
+        sdk_config = config['SDK']
+        self.client = SdkClient(config,
+                                pool_size=sdk_config.getint('POOL_SIZE', fallback=16),
+                                retries=sdk_config.getint('RETRIES', fallback=3),
+                                backoff_factor=sdk_config.getfloat('BACKOFF', fallback=0.5))
+        # 鉴权在首次调用接口时获取，轨迹全部来自本地存储时不需要登录
+        # 本地轨迹存储，未配置存储目录时不启用
+        store_dir = config.get('trajectory_store', 'root_dir', fallback=None)
+        self.trajectory_store = TrajectoryStore(
+            store_dir, config.getint('trajectory_store', 'retention_days', fallback=DEFAULT_RETENTION_DAYS)
+        ) if store_dir else None
 
     def get_authorization(self):
-        """获取SDK接口调用的鉴权"""
-        params = {
-            "username": self.config['SDK']['USERNAME'],
-            "password": self.config['SDK']['PASSWORD']
-        }
-        response = requests.post(self.config['SDK']['LOGIN_URL'], data=params)
-        if response.status_code != 200:
-            raise Exception("获取Authorization失败")
-        data = json.loads(response.text)["data"]
-        return data["token_type"] + " " + data["access_token"]
+        """获取SDK接口调用的鉴权，有效期内复用同一个鉴权"""
+        return self.client.get_token()
 
     @staticmethod
-    def get_get_response_body_json(param_map, url, authorization):
-        """
-        调用SDK接口获取数据
-        :param param_map: 用户名、密码
-        :param url: url
-        :param authorization: token
-        :return: 获取数据
-        """
-        real_url = url
-        if param_map:
-            real_url += "?"
-            for key, value in param_map.items():
-                real_url += f"{key}={value}&"
-            real_url = real_url[:-1]  # Remove the last "&" character
-        headers = {
-            "Content-Type": "application/json;charset=UTF-8",
-            "Authorization": authorization
-        }
-        try:
-            response = requests.get(real_url, headers=headers)
-            if response.status_code != 200:
-                print(f"调用接口：{real_url} 失败")
-                return None
-            return json.loads(response.text)
-        except Exception as e:
-            print(f"调用接口：{real_url} 失败: {str(e)}")
-            return None
-
-    def fetch_vehicle_history(self,vin, start_time, end_time):
-        authorization = self.get_authorization()
+    def build_history_params(vin, start_time, end_time):
+        """构造获取国标历史数据的请求参数"""
         timestamp_start = int(start_time.timestamp() * 1000)
         timestamp_end = int(end_time.timestamp() * 1000)
-        params = {
+        return {
             "vin": vin,
             "timeStar": timestamp_start,
             "timeEnd": timestamp_end
         }
 
-        url = self.config['SDK']['GET_URL']
-
-        # 调用获取国标历史数据的方法
-        data = DataFetcher.get_get_response_body_json(params, url, authorization)
-
+    @staticmethod
+    def parse_vehicle_history(vin, data):
+        """将接口返回的国标历史数据转换为经纬度DataFrame"""
         # 检查data是否为None
         if data is None or 'data' not in data or 'gbDataList' not in data['data']:
-            print(f"获取数据失败或数据格式不正确: {vin}")
-            return pd.DataFrame()
+            # 抛出异常而不是返回空数据，调用方才能区分获取失败和当天没有数据，失败的车辆可以重试
+            raise FetchError(f"获取数据失败或数据格式不正确: {vin}")
 
         # 提取指定字段的数据行
         rows = []
@@ -86,8 +67,79 @@ class DataFetcher:
         print(f"数据获取成功：{vin}")
         return df
 
+    def fetch_vehicle_history(self, vin, start_time, end_time, city=None):
+        """
+        获取车辆历史数据，启用本地轨迹存储且指定城市时优先读取本地数据
+        """
+        if self.trajectory_store and city:
+            return self.trajectory_store.get_or_fetch(
+                city, vin, start_time, end_time,
+                lambda: self.fetch_remote_history(vin, start_time, end_time))
+        return self.fetch_remote_history(vin, start_time, end_time)
+
+    def fetch_remote_history(self, vin, start_time, end_time):
+        params = DataFetcher.build_history_params(vin, start_time, end_time)
+
+        url = self.config['SDK']['GET_URL']
+
+        # 调用获取国标历史数据的方法，共用连接池和鉴权
+        data = self.client.get_json(url, params)
+        return DataFetcher.parse_vehicle_history(vin, data)
+
+    async def fetch_vehicle_history_async(self, session, vin, start_time, end_time, city=None):
+        """
+        异步获取车辆历史数据，多辆车共用同一个会话的连接池，启用本地轨迹存储且指定城市时优先读取本地数据。
+        本地轨迹的读写为同步文件操作，放在线程池中执行，避免阻塞事件循环
+        :param session: aiohttp.ClientSession
+        """
+        loop = asyncio.get_running_loop()
+        if self.trajectory_store and city:
+            vehicle_history = await loop.run_in_executor(
+                None, self.trajectory_store.load, city, vin, start_time, end_time)
+            if vehicle_history is not None:
+                return vehicle_history
+        vehicle_history = await self.fetch_remote_history_async(session, vin, start_time, end_time)
+        if self.trajectory_store and city:
+            await loop.run_in_executor(
+                None, self.trajectory_store.save, city, vin, start_time, end_time, vehicle_history)
+        return vehicle_history
+
+    async def fetch_remote_history_async(self, session, vin, start_time, end_time):
+        params = DataFetcher.build_history_params(vin, start_time, end_time)
+        url = self.config['SDK']['GET_URL']
+        retries = self.config['SDK'].getint('RETRIES', fallback=3)
+        backoff_factor = self.config['SDK'].getfloat('BACKOFF', fallback=0.5)
+        token_refreshed = False
+        data = None
+        attempt = 0
+        loop = asyncio.get_running_loop()
+        while attempt <= retries:
+            # 鉴权在有效期内直接复用，只有过期时才会登录；登录为同步请求，放在线程池中执行
+            token = await loop.run_in_executor(None, self.client.get_token)
+            headers = {
+                "Content-Type": "application/json;charset=UTF-8",
+                "Authorization": token
+            }
+            try:
+                async with session.get(url, params=params, headers=headers) as response:
+                    if response.status == 401 and not token_refreshed:
+                        await loop.run_in_executor(None, self.client.invalidate_token, token)
+                        token_refreshed = True
+                        continue
+                    if response.status == 200:
+                        data = json.loads(await response.text())
+                        break
+                    if response.status not in RETRY_STATUS:
+                        print(f"调用接口：{url} 失败: {vin}: {response.status}")
+                        break
+            except Exception as e:
+                print(f"调用接口：{url} 失败: {vin}: {str(e)}")
+            # 服务端繁忙或网络异常时退避重试
+            await asyncio.sleep(backoff_factor * (2 ** attempt))
+            attempt += 1
+        return await loop.run_in_executor(None, DataFetcher.parse_vehicle_history, vin, data)
+
     def fetch_and_save_vehicle_info(self):
-        token = self.get_authorization()
         all_vehicles = []
         current_page = 1
         while True:
@@ -98,14 +150,10 @@ class DataFetcher:
                 'limit': 100
             }
 
-            headers = {
-                'Authorization': token
-            }
-
-            response = requests.get(self.config['SDK']['INFO_URL'], headers=headers, params=params)
+            response = self.client.get_json(self.config['SDK']['INFO_URL'], params)
 
-            if response.status_code == 200:
-                data = response.json()['data']
+            if response is not None:
+                data = response['data']
                 all_vehicles.extend(data['list'])
 
                 if current_page < data['totalPage']:
@@ -113,7 +161,7 @@ class DataFetcher:
                 else:
                     break
             else:
-                print(f'Error fetching page {current_page}: {response.status_code}')
+                print(f'Error fetching page {current_page}')
                 break
             time.sleep(1)
 
@@ -4,6 +4,8 @@
 import mysql.connector
 from mysql.connector import Error
 import json
+import threading
+from db_pool import get_pool
 
 class DatabaseManager:
     def __init__(self, db_config, city):
@@ -15,8 +17,9 @@ class DatabaseManager:
         return f"{self.table_prefix}_{table_type}"
 
     def connect(self):
+        """从进程内共享的连接池获取连接，close()时归还连接池"""
         try:
-            self.connection = mysql.connector.connect(**self.db_config)
+            self.connection = get_pool(self.db_config).get_connection()
             return self.connection
         except Error as e:
             print(f"Error connecting to MySQL database: {e}")
@@ -24,6 +27,7 @@ class DatabaseManager:
 
     def insert_match_result(self, vin, matched_route, match_rate, route_coverage, date, city):
         table_name = "match_results" if city.lower() == "yangzhou" else f"match_results_{city.lower()}"
+        connection = None
         try:
             connection = self.connect()
             cursor = connection.cursor()
@@ -34,9 +38,12 @@ class DatabaseManager:
             cursor.execute(insert_query, (vin, matched_route, match_rate, route_coverage, date))
             connection.commit()
             cursor.close()
-            connection.close()
         except mysql.connector.Error as e:
             print(f"Error: {e}")
+        finally:
+            # 出错时也要归还连接池
+            if connection is not None:
+                connection.close()
 
     def get_vins_by_order_or_model(self, query_value, query_type,vehicle_df):
         #需要查询库关联表，通过订单/车型查询响应的vin列表
@@ -53,12 +60,12 @@ class DatabaseManager:
 
         return vins
 
-    def get_match_results(self, start_date=None, end_date=None, vins=None, city='default'):
-        if vins is not None and len(vins) == 0:
-            return []
-
-        table_name = f"match_results_{city.lower()}"
-        query = f"SELECT * FROM {table_name}"
+    @staticmethod
+    def build_result_conditions(start_date=None, end_date=None, vins=None):
+        """
+        构造匹配结果查询的日期和VIN条件
+        :return: (条件列表, 参数列表)
+        """
         conditions = []
         params = []
 
@@ -79,9 +86,20 @@ class DatabaseManager:
             conditions.append("vin IN (" + vin_placeholders + ")")
             params.extend(vins)
 
+        return conditions, params
+
+    def get_match_results(self, start_date=None, end_date=None, vins=None, city='default'):
+        if vins is not None and len(vins) == 0:
+            return []
+
+        table_name = f"match_results_{city.lower()}"
+        query = f"SELECT * FROM {table_name}"
+        conditions, params = self.build_result_conditions(start_date, end_date, vins)
+
         if conditions:
             query += " WHERE " + " AND ".join(conditions)
 
+        connection = None
         try:
             connection = self.connect()
             if connection.is_connected():
@@ -89,11 +107,105 @@ class DatabaseManager:
                 cursor.execute(query, tuple(params))
                 results = cursor.fetchall()
                 cursor.close()
-                connection.close()
                 return results
         except Error as e:
             print(f"Error reading data from MySQL table: {e}")
             return []
+        finally:
+            if connection is not None:
+                connection.close()
+
+    def count_match_results(self, start_date=None, end_date=None, vins=None, city='default'):
+        """
+        统计满足条件的匹配结果数量，查询失败时抛出异常
+        """
+        if vins is not None and len(vins) == 0:
+            return 0
+
+        table_name = f"match_results_{city.lower()}"
+        query = f"SELECT COUNT(*) FROM {table_name}"
+        conditions, params = self.build_result_conditions(start_date, end_date, vins)
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+
+        connection = self.connect()
+        try:
+            cursor = connection.cursor()
+            cursor.execute(query, tuple(params))
+            count = cursor.fetchone()[0]
+            cursor.close()
+            return count
+        finally:
+            connection.close()
+
+    def get_match_results_page(self, start_date=None, end_date=None, vins=None, city='default',
+                               limit=10, offset=0, after=None):
+        """
+        按(date, vin)排序分页查询匹配结果，查询失败时抛出异常。
+        结果表上需要对应的索引，翻页时才不会扫描之前的记录：
+        ALTER TABLE match_results_xxx ADD KEY idx_date_vin (date, vin);
+        :param limit: 返回的最大条数
+        :param offset: 跳过的条数
+        :param after: 上一页最后一条记录的(date, vin)，指定时从其之后开始查询
+        """
+        if vins is not None and len(vins) == 0:
+            return []
+
+        table_name = f"match_results_{city.lower()}"
+        query = f"SELECT * FROM {table_name}"
+        conditions, params = self.build_result_conditions(start_date, end_date, vins)
+        if after is not None:
+            conditions.append("(date > %s OR (date = %s AND vin > %s))")
+            params.extend([after[0], after[0], after[1]])
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY date, vin LIMIT %s OFFSET %s"
+        params.extend([limit, offset])
+
+        connection = self.connect()
+        try:
+            cursor = connection.cursor(dictionary=True)
+            cursor.execute(query, tuple(params))
+            results = cursor.fetchall()
+            cursor.close()
+            return results
+        finally:
+            connection.close()
+
+    def iter_match_results(self, start_date=None, end_date=None, vins=None, city='default', chunk_size=1000):
+        """
+        按(date, vin)顺序逐批读取匹配结果，使用非缓冲游标，内存占用与结果总量无关。
+        读取期间一直占用一个数据库连接，生成器结束或关闭时归还
+        :param chunk_size: 每次从服务端读取的行数
+        """
+        if vins is not None and len(vins) == 0:
+            return
+
+        table_name = f"match_results_{city.lower()}"
+        query = f"SELECT * FROM {table_name}"
+        conditions, params = self.build_result_conditions(start_date, end_date, vins)
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY date, vin"
+
+        connection = self.connect()
+        cursor = None
+        try:
+            cursor = connection.cursor(dictionary=True, buffered=False)
+            cursor.execute(query, tuple(params))
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield from rows
+        finally:
+            # 提前结束时游标中还有未读取的结果，关闭失败的连接由连接池丢弃
+            if cursor is not None:
+                try:
+                    cursor.close()
+                except Error:
+                    pass
+            connection.close()
 
     def insert_match_line_GPS(self,top_route,vehicle_history):
         vehicle_history = vehicle_history.rename(columns={'经度': 'longitude', '纬度': 'latitude'})
@@ -105,6 +217,7 @@ class DatabaseManager:
         vehicle_history_json_str = json.dumps(vehicle_history_json,ensure_ascii=False)
 
         #将匹配的路线插入数据表
+        connection = None
         try:
             connection = self.connect()
             if connection.is_connected():
@@ -128,7 +241,7 @@ class DatabaseManager:
         except Error as e:
             print(f"Error interacting with MySQL: {e}")
         finally:
-            if connection.is_connected():
+            if connection is not None:
                 connection.close()
 
     def get_line_GPS(self, tableName = None,lineName=None):
@@ -144,6 +257,7 @@ class DatabaseManager:
         if conditions:
             query += " WHERE " + " AND ".join(conditions)
 
+        connection = None
         try:
             connection = self.connect()
             if connection.is_connected():
@@ -151,8 +265,97 @@ class DatabaseManager:
                 cursor.execute(query, tuple(params))
                 results = cursor.fetchall()
                 cursor.close()
-                connection.close()
                 return results
         except Error as e:
             print(f"Error reading data from MySQL table: {e}")
-            return []
\ No newline at end of file
+            return []
+        finally:
+            if connection is not None:
+                connection.close()
+
+class MatchResultWriter:
+    """
+    匹配结果的批量写入器，结果产生后先缓存，达到批量大小时通过同一个连接批量写入。
+    以(vin, date)去重，重复运行同一天的任务会覆盖已有结果，要求结果表上有对应的唯一索引：
+    ALTER TABLE match_results_xxx ADD UNIQUE KEY uk_vin_date (vin, date);
+    """
+    def __init__(self, db_manager, city, batch_size=500, on_written=None, on_failed=None):
+        """
+        :param on_written: 一批结果写入成功后调用，参数为该批结果行
+        :param on_failed: 一批结果写入失败后调用，参数为该批结果行
+        """
+        self.db_manager = db_manager
+        self.on_written = on_written
+        self.on_failed = on_failed
+        self.table_name = "match_results" if city.lower() == "yangzhou" else f"match_results_{city.lower()}"
+        self.batch_size = batch_size
+        self.rows = []
+        self.lock = threading.Lock()
+        self.connection = None
+        self.written = 0
+        self.failed = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def add(self, vin, matched_route, match_rate, route_coverage, date):
+        with self.lock:
+            self.rows.append((vin, matched_route, match_rate, route_coverage, date))
+            if len(self.rows) >= self.batch_size:
+                self.write_rows()
+
+    def flush(self):
+        with self.lock:
+            self.write_rows()
+
+    def write_rows(self):
+        """
+        写入缓存的结果（需持有self.lock），连接断开时重连一次
+        """
+        if not self.rows:
+            return
+        insert_query = f"""
+                INSERT INTO {self.table_name} (vin, matched_route, match_rate, route_coverage, date)
+                VALUES (%s, %s, %s, %s, %s)
+                ON DUPLICATE KEY UPDATE matched_route = VALUES(matched_route),
+                    match_rate = VALUES(match_rate), route_coverage = VALUES(route_coverage)
+                """
+        for attempt in range(2):
+            try:
+                if self.connection is None or not self.connection.is_connected():
+                    self.release_connection()
+                    self.connection = self.db_manager.connect()
+                cursor = self.connection.cursor()
+                cursor.executemany(insert_query, self.rows)
+                self.connection.commit()
+                cursor.close()
+                self.written += len(self.rows)
+                rows, self.rows = self.rows, []
+                if self.on_written:
+                    self.on_written(rows)
+                return
+            except (Error, AttributeError) as e:
+                print(f"Error writing match results: {e}")
+                self.release_connection()
+        self.failed += len(self.rows)
+        rows, self.rows = self.rows, []
+        if self.on_failed:
+            self.on_failed(rows)
+
+    def release_connection(self):
+        """
+        归还当前连接，无论连接是否仍然可用，连接池都需要收回占用的位置
+        """
+        if self.connection is not None:
+            connection, self.connection = self.connection, None
+            try:
+                connection.close()
+            except Error:
+                pass
+
+    def close(self):
+        self.flush()
+        self.release_connection()
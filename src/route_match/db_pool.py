@@ -0,0 +1,159 @@
+import queue
+import threading
+import mysql.connector
+from mysql.connector import Error
+from mysql.connector.errors import PoolError
+
+#连接池默认大小
+DEFAULT_POOL_SIZE = 10
+#连接池已满时获取连接的等待时间（秒）
+ACQUIRE_TIMEOUT = 30
+
+#进程内按数据库配置共享的连接池
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(db_config, pool_size=None):
+    """
+    获取数据库配置对应的连接池，同一进程内相同配置共用一个连接池
+    :param pool_size: 连接池大小，只在首次创建时生效
+    """
+    key = tuple(sorted(db_config.items()))
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = ConnectionPool(db_config, pool_size or DEFAULT_POOL_SIZE)
+            _pools[key] = pool
+        return pool
+
+
+def pool_stats():
+    with _pools_lock:
+        pools = list(_pools.values())
+    return [pool.stats() for pool in pools]
+
+
+class PooledConnection:
+    """
+    连接池中的连接，调用close()时归还连接池而不是断开
+    """
+    def __init__(self, pool, connection):
+        self._pool = pool
+        self._connection = connection
+
+    def __getattr__(self, name):
+        if self._connection is None:
+            raise PoolError("连接已归还连接池")
+        return getattr(self._connection, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def is_connected(self):
+        return self._connection is not None and self._connection.is_connected()
+
+    def close(self):
+        if self._connection is not None:
+            connection, self._connection = self._connection, None
+            self._pool.release(connection)
+
+
+class ConnectionPool:
+    """
+    大小有上限的MySQL连接池，取出连接时检查连接是否可用，并记录使用情况
+    """
+    def __init__(self, db_config, pool_size=DEFAULT_POOL_SIZE, acquire_timeout=ACQUIRE_TIMEOUT):
+        self.db_config = db_config
+        self.pool_size = pool_size
+        self.acquire_timeout = acquire_timeout
+        self.idle = queue.LifoQueue()
+        self.slots = threading.BoundedSemaphore(pool_size)
+        self.lock = threading.Lock()
+        self.created = 0
+        self.in_use = 0
+        self.peak_in_use = 0
+        self.acquired = 0
+        self.waits = 0
+        self.health_check_failures = 0
+
+    def get_connection(self):
+        """
+        从连接池获取连接，连接池已满时等待其他连接归还
+        """
+        if not self.slots.acquire(blocking=False):
+            with self.lock:
+                self.waits += 1
+            if not self.slots.acquire(timeout=self.acquire_timeout):
+                raise PoolError(f"等待数据库连接超时，连接池大小：{self.pool_size}")
+
+        try:
+            connection = self.take_idle()
+            if connection is None:
+                connection = mysql.connector.connect(**self.db_config)
+                with self.lock:
+                    self.created += 1
+        except Exception:
+            self.slots.release()
+            raise
+
+        with self.lock:
+            self.in_use += 1
+            self.acquired += 1
+            self.peak_in_use = max(self.peak_in_use, self.in_use)
+        return PooledConnection(self, connection)
+
+    def take_idle(self):
+        """
+        取出一个可用的空闲连接，不可用的连接直接丢弃
+        """
+        while True:
+            try:
+                connection = self.idle.get_nowait()
+            except queue.Empty:
+                return None
+            try:
+                connection.ping(reconnect=False)
+                return connection
+            except Error:
+                with self.lock:
+                    self.health_check_failures += 1
+                try:
+                    connection.close()
+                except Error:
+                    pass
+
+    def release(self, connection):
+        try:
+            # 回滚未提交的事务，避免影响下一个使用者
+            if connection.is_connected():
+                connection.rollback()
+                self.idle.put(connection)
+        except Error:
+            # 还有未读取结果等无法复用的连接直接断开
+            try:
+                connection.close()
+            except Error:
+                pass
+        finally:
+            with self.lock:
+                self.in_use -= 1
+            self.slots.release()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'host': self.db_config.get('host'),
+                'database': self.db_config.get('database'),
+                'pool_size': self.pool_size,
+                'in_use': self.in_use,
+                'idle': self.idle.qsize(),
+                'peak_in_use': self.peak_in_use,
+                'created': self.created,
+                'acquired': self.acquired,
+                'waits': self.waits,
+                'health_check_failures': self.health_check_failures
+            }
@@ -0,0 +1,45 @@
+import os
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+
+
+class ElevationIndex:
+    """
+    城市高程数据的空间索引，加载时建立一次k-d树，所有坡度请求共用
+    """
+    def __init__(self, lngArr, latArr, altitudeArr, version=None):
+        self.altitude = np.ascontiguousarray(altitudeArr, dtype=np.float64)
+        self.version = version
+        # 坐标只保存在k-d树中，不另外保留经纬度数组
+        self.tree = cKDTree(np.column_stack((np.asarray(lngArr, dtype=np.float64),
+                                             np.asarray(latArr, dtype=np.float64))))
+
+    @classmethod
+    def from_parquet(cls, parquet_path):
+        """
+        从高程parquet文件建立索引，文件的修改时间和大小作为数据版本
+        """
+        col_data = pd.read_parquet(parquet_path, columns=['经度', '纬度', '高程'])
+        stat = os.stat(parquet_path)
+        version = f"{int(stat.st_mtime)}-{stat.st_size}"
+        return cls(col_data['经度'].to_numpy(), col_data['纬度'].to_numpy(), col_data['高程'].to_numpy(), version)
+
+    def __len__(self):
+        return len(self.altitude)
+
+    @property
+    def nbytes(self):
+        """
+        索引占用内存的估算值（字节），包括高程以及k-d树中的坐标和排序下标
+        """
+        return self.altitude.nbytes + self.tree.data.nbytes + self.tree.indices.nbytes
+
+    def query(self, lngArr, latArr):
+        """
+        批量查询各位置最近的高程点
+        :return: 高程数组
+        """
+        points = np.column_stack((np.asarray(lngArr, dtype=np.float64), np.asarray(latArr, dtype=np.float64)))
+        _, index = self.tree.query(points, k=1)
+        return self.altitude[index]
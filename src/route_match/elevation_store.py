@@ -0,0 +1,97 @@
+import threading
+from collections import OrderedDict
+from elevation_index import ElevationIndex
+
+
+class ElevationStore:
+    """
+    按需加载各城市高程数据，超出内存预算时淘汰最久未使用的城市。
+    同一城市并发的首次请求只会加载一次
+    """
+    def __init__(self, elevation_config, memory_budget_mb=0):
+        self.elevation_config = elevation_config
+        # 内存预算（字节），0表示不限制
+        self.memory_budget = int(memory_budget_mb * 1024 * 1024)
+        self.indexes = OrderedDict()
+        self.city_locks = {}
+        self.lock = threading.Lock()
+        self.load_count = 0
+        self.evict_count = 0
+
+    def __contains__(self, city):
+        return city in self.elevation_config
+
+    def __getitem__(self, city):
+        return self.get(city)
+
+    def get(self, city):
+        """
+        获取城市的高程索引，未加载时从parquet文件加载
+        """
+        if city not in self.elevation_config:
+            raise KeyError(city)
+
+        with self.lock:
+            index = self.indexes.get(city)
+            if index is not None:
+                self.indexes.move_to_end(city)
+                return index
+            city_lock = self.city_locks.setdefault(city, threading.Lock())
+
+        # 每个城市单独加锁，加载大文件时不阻塞其他城市的请求
+        with city_lock:
+            with self.lock:
+                index = self.indexes.get(city)
+                if index is not None:
+                    self.indexes.move_to_end(city)
+                    return index
+
+            print(f"加载高程数据：{city}")
+            index = ElevationIndex.from_parquet(self.elevation_config[city]['parquet_path'])
+
+            with self.lock:
+                self.indexes[city] = index
+                self.load_count += 1
+                self.evict(keep=city)
+        return index
+
+    def evict(self, keep=None):
+        """
+        淘汰最久未使用的城市，直到占用内存不超过预算（需持有self.lock）
+        """
+        if not self.memory_budget:
+            return
+        total = sum(index.nbytes for index in self.indexes.values())
+        for city in list(self.indexes):
+            if total <= self.memory_budget:
+                break
+            if city == keep:
+                continue
+            total -= self.indexes.pop(city).nbytes
+            self.evict_count += 1
+            print(f"释放高程数据：{city}")
+
+    def prewarm(self, cities):
+        """
+        后台线程预先加载指定城市
+        """
+        def load_all():
+            for city in cities:
+                try:
+                    self.get(city)
+                except Exception as e:
+                    print(f"预加载高程数据失败：{city}: {e}")
+
+        thread = threading.Thread(target=load_all, daemon=True)
+        thread.start()
+        return thread
+
+    def stats(self):
+        with self.lock:
+            return {
+                'loaded_cities': list(self.indexes),
+                'memory_bytes': sum(index.nbytes for index in self.indexes.values()),
+                'memory_budget_bytes': self.memory_budget,
+                'loads': self.load_count,
+                'evictions': self.evict_count
+            }
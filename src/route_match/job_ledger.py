@@ -0,0 +1,142 @@
+import time
+import sqlite3
+import threading
+
+#任务状态
+PENDING = 'pending'
+FETCHED = 'fetched'
+MATCHED = 'matched'
+WRITTEN = 'written'
+FAILED = 'failed'
+#失败任务的最大尝试次数
+MAX_ATTEMPTS = 5
+#失败重试的退避时间（秒），第n次失败后等待 RETRY_BACKOFF * 2^(n-1)，不超过 MAX_RETRY_BACKOFF
+RETRY_BACKOFF = 60
+MAX_RETRY_BACKOFF = 3600
+
+
+class JobLedger:
+    """
+    定时任务的持久化台账，记录每个城市每天每辆车的处理状态：
+    pending -> fetched -> matched -> written，失败时为failed并按退避时间重试。
+    任务中断后重新运行时，已完成的车辆直接跳过，已匹配未写入的结果直接写入
+    """
+    def __init__(self, path, max_attempts=MAX_ATTEMPTS, retry_backoff=RETRY_BACKOFF):
+        self.path = path
+        self.max_attempts = max_attempts
+        self.retry_backoff = retry_backoff
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    city TEXT NOT NULL,
+                    day TEXT NOT NULL,
+                    vin TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    next_attempt_at REAL NOT NULL DEFAULT 0,
+                    matched_route TEXT,
+                    match_rate REAL,
+                    route_coverage REAL,
+                    error TEXT,
+                    updated_at REAL NOT NULL,
+                    PRIMARY KEY (city, day, vin)
+                )""")
+
+    def execute(self, query, params=()):
+        with self.lock, self.connection:
+            return self.connection.execute(query, params).fetchall()
+
+    def prepare(self, city, day, vehicle_ids):
+        """
+        登记当天的车辆，已有记录的保持原状态
+        :return: (需要获取和匹配的VIN列表, 已匹配未写入的结果列表[(vin, 最佳路线, 匹配率, 路径覆盖度)])
+        """
+        now = time.time()
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO jobs (city, day, vin, status, updated_at) VALUES (?, ?, ?, ?, ?)",
+                [(city, str(day), vin, PENDING, now) for vin in vehicle_ids])
+        return self.runnable(city, day, vehicle_ids), self.unwritten(city, day, vehicle_ids)
+
+    def runnable(self, city, day, vehicle_ids):
+        """
+        获取需要处理的VIN：未完成的，以及未超过尝试次数且已到重试时间的失败任务
+        """
+        rows = self.execute(
+            "SELECT vin FROM jobs WHERE city = ? AND day = ? AND "
+            "(status IN (?, ?) OR (status = ? AND attempts < ? AND next_attempt_at <= ?))",
+            (city, str(day), PENDING, FETCHED, FAILED, self.max_attempts, time.time()))
+        vins = {row[0] for row in rows}
+        return [vin for vin in vehicle_ids if vin in vins]
+
+    def unwritten(self, city, day, vehicle_ids):
+        rows = self.execute(
+            "SELECT vin, matched_route, match_rate, route_coverage FROM jobs "
+            "WHERE city = ? AND day = ? AND status = ?", (city, str(day), MATCHED))
+        vins = set(vehicle_ids)
+        return [row for row in rows if row[0] in vins]
+
+    def next_retry_at(self, city, day):
+        """
+        :return: 最早可以重试的失败任务的时间，没有可重试的任务时返回None
+        """
+        rows = self.execute(
+            "SELECT MIN(next_attempt_at) FROM jobs WHERE city = ? AND day = ? AND status = ? AND attempts < ?",
+            (city, str(day), FAILED, self.max_attempts))
+        return rows[0][0]
+
+    def mark_fetched(self, city, day, vin):
+        self.execute("UPDATE jobs SET status = ?, updated_at = ? WHERE city = ? AND day = ? AND vin = ?",
+                     (FETCHED, time.time(), city, str(day), vin))
+
+    def mark_matched(self, city, day, vin, route_request):
+        """
+        记录匹配结果
+        :param route_request: (vin, 最佳路线, 匹配率, 路径覆盖度)，未匹配到路线时为None，没有需要写入的结果，直接完成
+        """
+        if route_request is None:
+            self.execute("UPDATE jobs SET status = ?, error = NULL, updated_at = ? "
+                         "WHERE city = ? AND day = ? AND vin = ?",
+                         (WRITTEN, time.time(), city, str(day), vin))
+            return
+        _, matched_route, match_rate, route_coverage = route_request
+        self.execute("UPDATE jobs SET status = ?, matched_route = ?, match_rate = ?, route_coverage = ?, "
+                     "error = NULL, updated_at = ? WHERE city = ? AND day = ? AND vin = ?",
+                     (MATCHED, matched_route, match_rate, route_coverage, time.time(), city, str(day), vin))
+
+    def mark_written(self, city, day, vins):
+        now = time.time()
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "UPDATE jobs SET status = ?, updated_at = ? WHERE city = ? AND day = ? AND vin = ?",
+                [(WRITTEN, now, city, str(day), vin) for vin in vins])
+
+    def mark_failed(self, city, day, vin, error):
+        """
+        记录失败，并按已尝试次数计算下次重试时间
+        """
+        now = time.time()
+        with self.lock, self.connection:
+            row = self.connection.execute("SELECT attempts FROM jobs WHERE city = ? AND day = ? AND vin = ?",
+                                          (city, str(day), vin)).fetchone()
+            attempts = (row[0] if row else 0) + 1
+            backoff = min(self.retry_backoff * 2 ** (attempts - 1), MAX_RETRY_BACKOFF)
+            self.connection.execute(
+                "UPDATE jobs SET status = ?, attempts = ?, next_attempt_at = ?, error = ?, updated_at = ? "
+                "WHERE city = ? AND day = ? AND vin = ?",
+                (FAILED, attempts, now + backoff, str(error), now, city, str(day), vin))
+
+    def summary(self, city, day):
+        """
+        :return: 各状态的车辆数量
+        """
+        rows = self.execute("SELECT status, COUNT(*) FROM jobs WHERE city = ? AND day = ? GROUP BY status",
+                            (city, str(day)))
+        return dict(rows)
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
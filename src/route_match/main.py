@@ -43,6 +43,7 @@ def get_id_order_model(file_path):
 
 
 #以下代码用来单独触发任务，项目正常运行时无需用到
+#补跑多天或指定车辆的结果请使用backfill.py
 # if __name__ == '__main__':
 #     config, db_config = load_config()
 #
@@ -65,7 +66,7 @@ def get_id_order_model(file_path):
 #
 #     for city, vehicle_ids in city_vehicle_ids.items():
 #         db_manager = DatabaseManager(db_config, city)
-#         route_matcher = RouteMatcher(db_config, city)
+#         route_matcher = RouteMatcher(db_config, city, config['filepath'].get('route_snapshot_dir'))
 #         task_manager = TaskManager(data_fetcher, route_matcher)
 #         task_manager.manage_tasks(vehicle_ids, start_time, end_time, db_manager, city)
 
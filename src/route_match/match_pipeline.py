@@ -0,0 +1,134 @@
+import os
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+#进程内的线路模型，由进程初始化函数加载一次，之后所有匹配任务共用
+_worker_route_matcher = None
+
+
+def init_match_worker(route_matcher):
+    global _worker_route_matcher
+    _worker_route_matcher = route_matcher
+
+
+def match_in_worker(vehicle_history):
+    """
+    在匹配进程中执行路线匹配
+    :return: (最佳路线, 匹配率, 路径覆盖度)，未匹配到时返回None
+    """
+    matched_route, route_match_rates, route_coverage = _worker_route_matcher.match_route(vehicle_history)
+    if not matched_route:
+        return None
+    return matched_route, route_match_rates[matched_route], route_coverage[matched_route]
+
+
+class MatchPipeline:
+    """
+    分阶段的匹配流水线：多个I/O线程获取轨迹数据，进程池进行路线匹配，结果线程保存结果。
+    各阶段之间使用有界队列，下游处理不过来时上游自动等待，内存占用保持稳定
+    """
+    def __init__(self, data_fetcher, route_matcher, fetch_workers=8, match_workers=None, queue_size=64, city=None):
+        """
+        :param city: 任务所属城市，用于读取本地轨迹存储
+        """
+        self.data_fetcher = data_fetcher
+        self.route_matcher = route_matcher
+        self.fetch_workers = fetch_workers
+        self.match_workers = match_workers or os.cpu_count() or 1
+        self.queue_size = queue_size
+        self.city = city
+
+    def fetch_worker(self, task_queue, history_queue, on_fetched):
+        while True:
+            task = task_queue.get()
+            if task is None:
+                history_queue.put(None)
+                break
+            vin, start_time, end_time = task
+            try:
+                vehicle_history = self.data_fetcher.fetch_vehicle_history(vin, start_time, end_time, city=self.city)
+                if on_fetched:
+                    on_fetched(task)
+                history_queue.put((task, vehicle_history, None))
+            except Exception as e:
+                history_queue.put((task, None, e))
+
+    def result_worker(self, result_queue, on_result, on_error):
+        while True:
+            item = result_queue.get()
+            if item is None:
+                break
+            task, matched, error = item
+            try:
+                if error is not None:
+                    on_error(task, error)
+                else:
+                    on_result(task, matched)
+            except Exception as e:
+                print(f"保存 {task[0]} 的匹配结果时发生错误: {e}")
+
+    def run(self, tasks, on_result, on_error=None, on_fetched=None):
+        """
+        执行流水线
+        :param tasks: 可迭代的(vin, start_time, end_time)任务
+        :param on_result: 匹配完成后在结果线程中调用，参数为(任务, 匹配结果)，匹配结果为match_in_worker的返回值
+        :param on_error: 获取或匹配失败时在结果线程中调用，参数为(任务, 异常)
+        :param on_fetched: 数据获取成功后在获取线程中调用，参数为任务
+        """
+        if on_error is None:
+            on_error = lambda task, error: print(f"在处理 {task[0]} 时发生错误: {error}")
+
+        task_queue = queue.Queue(maxsize=self.queue_size)
+        history_queue = queue.Queue(maxsize=self.queue_size)
+        result_queue = queue.Queue(maxsize=self.queue_size)
+        # 限制已提交但未完成的匹配任务数量
+        in_flight = threading.BoundedSemaphore(self.match_workers * 2)
+
+        fetch_threads = [threading.Thread(target=self.fetch_worker, args=(task_queue, history_queue, on_fetched),
+                                          daemon=True)
+                         for _ in range(self.fetch_workers)]
+        result_thread = threading.Thread(target=self.result_worker, args=(result_queue, on_result, on_error), daemon=True)
+
+        def feed():
+            for task in tasks:
+                task_queue.put(task)
+            for _ in range(self.fetch_workers):
+                task_queue.put(None)
+
+        feed_thread = threading.Thread(target=feed, daemon=True)
+        for thread in fetch_threads + [result_thread, feed_thread]:
+            thread.start()
+
+        def on_done(task, future):
+            in_flight.release()
+            try:
+                result_queue.put((task, future.result(), None))
+            except Exception as e:
+                result_queue.put((task, None, e))
+
+        with ProcessPoolExecutor(max_workers=self.match_workers, initializer=init_match_worker,
+                                 initargs=(self.route_matcher,)) as executor:
+            finished_fetchers = 0
+            while finished_fetchers < self.fetch_workers:
+                item = history_queue.get()
+                if item is None:
+                    finished_fetchers += 1
+                    continue
+                task, vehicle_history, error = item
+                if error is not None:
+                    result_queue.put((task, None, error))
+                    continue
+                # 没有轨迹数据时无需提交到匹配进程
+                if vehicle_history.empty:
+                    result_queue.put((task, None, None))
+                    continue
+                in_flight.acquire()
+                future = executor.submit(match_in_worker, vehicle_history)
+                future.add_done_callback(lambda f, task=task: on_done(task, f))
+
+        result_queue.put(None)
+        result_thread.join()
+        feed_thread.join()
+        for thread in fetch_threads:
+            thread.join()
@@ -0,0 +1,149 @@
+import os
+import json
+import time
+import hashlib
+import threading
+
+
+class PolylineCache:
+    """
+    高德公交路线折线的本地缓存，按城市、起终点和线路名称缓存。
+    超过有效期但仍在过期容忍期内的缓存先返回旧数据，同时在后台刷新
+    """
+    def __init__(self, cache_dir, ttl_seconds=7 * 86400, stale_seconds=30 * 86400):
+        self.cache_dir = cache_dir
+        self.ttl_seconds = ttl_seconds
+        self.stale_seconds = stale_seconds
+        self.lock = threading.Lock()
+        self.refreshing = set()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def make_key(city, origin, destination, route_name):
+        raw = json.dumps([city, origin, destination, route_name], ensure_ascii=False)
+        return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+    def get_path(self, city, key):
+        return os.path.join(self.cache_dir, city, f"{key}.json")
+
+    def read(self, city, key):
+        path = self.get_path(city, key)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def write(self, city, origin, destination, route_name, lngArr, latArr):
+        key = self.make_key(city, origin, destination, route_name)
+        path = self.get_path(city, key)
+        entry = {
+            'city': city,
+            'origin': origin,
+            'destination': destination,
+            'route_name': route_name,
+            'fetched_at': time.time(),
+            'lngArr': lngArr,
+            'latArr': latArr
+        }
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(entry, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    def version(self, city, origin, destination, route_name):
+        """
+        未过有效期的缓存条目的版本，用于在不请求接口的情况下判断折线是否变化
+        :return: 缓存键和获取时间，没有缓存或已过有效期时返回None
+        """
+        key = self.make_key(city, origin, destination, route_name)
+        entry = self.read(city, key)
+        if entry is None or time.time() - entry['fetched_at'] > self.ttl_seconds:
+            return None
+        return f"{key}:{entry['fetched_at']}"
+
+    def get_or_fetch(self, city, origin, destination, route_name, fetch):
+        """
+        读取缓存，未命中或已完全过期时调用fetch获取
+        :param fetch: 获取折线的函数，成功时返回(lngArr, latArr)，失败时返回错误信息字符串
+        :return: fetch的返回值或缓存的(lngArr, latArr)
+        """
+        key = self.make_key(city, origin, destination, route_name)
+        entry = self.read(city, key)
+        if entry is not None:
+            age = time.time() - entry['fetched_at']
+            if age <= self.ttl_seconds:
+                return entry['lngArr'], entry['latArr']
+            if age <= self.ttl_seconds + self.stale_seconds:
+                self.refresh_in_background(city, origin, destination, route_name, key, fetch)
+                return entry['lngArr'], entry['latArr']
+        return self.fetch_and_store(city, origin, destination, route_name, fetch)
+
+    def fetch_and_store(self, city, origin, destination, route_name, fetch):
+        result = fetch()
+        # 只缓存成功的结果，接口报错时返回的是字符串
+        if isinstance(result, tuple):
+            lngArr, latArr = result
+            try:
+                self.write(city, origin, destination, route_name, lngArr, latArr)
+            except OSError as e:
+                print(f"写入折线缓存失败：{city} {route_name}: {e}")
+        return result
+
+    def refresh_in_background(self, city, origin, destination, route_name, key, fetch):
+        with self.lock:
+            if key in self.refreshing:
+                return
+            self.refreshing.add(key)
+
+        def refresh():
+            try:
+                self.fetch_and_store(city, origin, destination, route_name, fetch)
+            except Exception as e:
+                print(f"刷新折线缓存失败：{city} {route_name}: {e}")
+            finally:
+                with self.lock:
+                    self.refreshing.discard(key)
+
+        threading.Thread(target=refresh, daemon=True).start()
+
+    def is_city_dir(self, city):
+        """
+        检查城市名称是否对应缓存目录下的一级子目录，防止通过路径跳出缓存目录
+        """
+        root = os.path.realpath(self.cache_dir)
+        city_dir = os.path.realpath(os.path.join(root, city))
+        return os.path.dirname(city_dir) == root and os.path.basename(city_dir) == city
+
+    def invalidate(self, city=None, route_name=None):
+        """
+        清除缓存，可按城市和线路名称筛选，均不指定时清除全部
+        :return: 清除的缓存数量
+        """
+        if city is not None:
+            if not self.is_city_dir(city):
+                raise ValueError(f"无效的城市名称：{city}")
+            cities = [city]
+        else:
+            cities = [name for name in os.listdir(self.cache_dir)
+                      if os.path.isdir(os.path.join(self.cache_dir, name)) and self.is_city_dir(name)]
+
+        removed = 0
+        for city_name in cities:
+            city_dir = os.path.join(self.cache_dir, city_name)
+            if not os.path.isdir(city_dir):
+                continue
+            for file_name in os.listdir(city_dir):
+                if not file_name.endswith('.json'):
+                    continue
+                if route_name is not None:
+                    entry = self.read(city_name, file_name[:-len('.json')])
+                    if entry is None or entry.get('route_name') != route_name:
+                        continue
+                try:
+                    os.remove(os.path.join(city_dir, file_name))
+                    removed += 1
+                except OSError:
+                    pass
+        return removed
@@ -0,0 +1,84 @@
+import os
+import pickle
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+class ResultCache:
+    """
+    计算结果缓存：内存中按LRU保留有限条目，可选落盘，进程重启后仍可命中
+    """
+    def __init__(self, max_entries=256, disk_dir=None):
+        self.max_entries = max_entries
+        self.disk_dir = disk_dir
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    def get_path(self, key):
+        digest = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+        return os.path.join(self.disk_dir, f"{digest}.pkl")
+
+    def get(self, key):
+        """
+        读取缓存，未命中时返回None
+        """
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+
+        if self.disk_dir:
+            try:
+                with open(self.get_path(key), 'rb') as f:
+                    stored_key, value = pickle.load(f)
+                if stored_key == key:
+                    with self.lock:
+                        self.disk_hits += 1
+                        self.store(key, value)
+                    return value
+            except (OSError, pickle.UnpicklingError, EOFError, ValueError):
+                pass
+
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, value):
+        with self.lock:
+            self.store(key, value)
+
+        if self.disk_dir:
+            path = self.get_path(key)
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            try:
+                with open(tmp_path, 'wb') as f:
+                    pickle.dump((key, value), f, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(tmp_path, path)
+            except OSError as e:
+                print(f"写入结果缓存失败：{path}: {e}")
+
+    def store(self, key, value):
+        """
+        写入内存并淘汰最久未使用的条目（需持有self.lock）
+        """
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses
+            }
@@ -6,13 +6,14 @@ import json
 from slope_cacu import SlopeCacu
 
 class RoadCondition:
-    def __init__(self, config, db_config,col_data):
+    def __init__(self, config, db_config,elevation_index, polyline_cache=None):
         self.config = config
         self.db_config = db_config
-        self.col_data = col_data
+        self.elevation_index = elevation_index
+        self.polyline_cache = polyline_cache
 
     def get_line_GPS(self, city_name,line_name):
-        slopecacu = SlopeCacu(self.config, self.db_config,self.col_data)
+        slopecacu = SlopeCacu(self.config, self.db_config,self.elevation_index,self.polyline_cache)
         lngArr, latArr = slopecacu.get_route_data(city_name,line_name)
         return lngArr, latArr
 
@@ -1,16 +1,41 @@
 # 作 者： Liuyaoqiu
 # 日 期： 2023/12/4
 
-import mysql.connector
 import json
-from math import radians, cos, sin, asin, sqrt
+from math import radians, cos, sin, asin, sqrt, floor
+import numpy as np
+from collections import defaultdict
 from database_manager import DatabaseManager
+from db_pool import get_pool
 import eviltransform
+from coord_transform import wgs2gcj_arrays
+from route_snapshot import RouteSnapshot
+
+#轨迹点与站点的匹配范围（度），经纬度差均小于该值时认为经过该站点
+STATION_TOLERANCE = 0.005
+#站点网格索引的格子边长，略大于匹配范围，保证命中站点只会落在相邻格子中
+GRID_CELL_SIZE = STATION_TOLERANCE * (1 + 1e-6)
+#轨迹点与站点范围边界的距离小于该值时不参与合并，避免浮点误差改变匹配结果
+EDGE_EPSILON = 1e-9
+#匹配率阈值，大于等于该阈值的路线中选择路径覆盖度最高的路线
+MATCH_RATE_THRESHOLD = 0.95
+#流式匹配时每批处理的轨迹点数量，每批处理后判断能否提前结束
+STREAM_CHUNK_SIZE = 256
 
 class RouteMatcher:
-    def __init__(self, db_config, city):
+    def __init__(self, db_config, city, snapshot_dir=None, early_stop=False):
+        """
+        :param early_stop: 为True时match_route使用流式匹配，最佳路线确定后提前结束。
+                           提前结束时其他路线的匹配率不完整，match_route只返回最佳路线的匹配率
+        """
         self.city = city
+        self.early_stop = early_stop
+        # 流式匹配使用的各路线站点数据，首次使用时建立
+        self.route_stations = None
+        self.snapshot = RouteSnapshot(snapshot_dir) if snapshot_dir else None
         self.stations_dict, self.total_stations_per_route, self.route_coverage = self.load_route_data(db_config, city)
+        self.station_grid = self.build_station_grid(self.stations_dict)
+        self.lon_edges, self.lat_edges = self.build_station_edges(self.stations_dict)
         self.db_manager = DatabaseManager(db_config, city)
 
     @staticmethod
@@ -50,8 +75,15 @@ class RouteMatcher:
 
     def load_route_data(self, db_config, city):
         table_name = "bus_routes" if city.lower() == "yangzhou" else f"bus_routes_{city.lower()}"
-        with mysql.connector.connect(**db_config) as cnx:
+        checksum = None
+        with get_pool(db_config).get_connection() as cnx:
             with cnx.cursor() as cursor:
+                # 线路表未变化时直接使用本地快照
+                if self.snapshot:
+                    checksum = RouteSnapshot.table_checksum(cursor, table_name)
+                    route_model = self.snapshot.load(city, checksum)
+                    if route_model is not None:
+                        return route_model
                 query = f"SELECT route_name, via_stations FROM {table_name}"
                 cursor.execute(query)
                 results = cursor.fetchall()
@@ -85,8 +117,105 @@ class RouteMatcher:
             # 计算并存储每条路线的总站点数
             total_stations_per_route[route_name] = len(via_stations_list)
         # print(stations_dict)
+        if self.snapshot:
+            self.snapshot.save(city, checksum, stations_dict, total_stations_per_route, route_coverage)
         return stations_dict, total_stations_per_route, route_coverage
 
+    @staticmethod
+    def grid_cell(lon, lat):
+        """
+        获取坐标所在的网格编号
+        """
+        return floor(lon / GRID_CELL_SIZE), floor(lat / GRID_CELL_SIZE)
+
+    def build_station_grid(self, stations_dict):
+        """
+        按网格对站点建立空间索引
+        :param stations_dict: 各站点关联的路线
+        :return: 网格编号到(站点序号, 站点名称)列表的映射
+        """
+        station_grid = defaultdict(list)
+        for station_order, (station_name, data) in enumerate(stations_dict.items()):
+            lon, lat = data['position']
+            station_grid[RouteMatcher.grid_cell(lon, lat)].append((station_order, station_name))
+        return dict(station_grid)
+
+    @staticmethod
+    def build_station_edges(stations_dict):
+        """
+        所有站点匹配范围在经度和纬度方向上的边界，排序后用于轨迹点精简
+        """
+        positions = np.array([data['position'] for data in stations_dict.values()], dtype=np.float64).reshape(-1, 2)
+        lon_edges = np.sort(np.concatenate([positions[:, 0] - STATION_TOLERANCE, positions[:, 0] + STATION_TOLERANCE]))
+        lat_edges = np.sort(np.concatenate([positions[:, 1] - STATION_TOLERANCE, positions[:, 1] + STATION_TOLERANCE]))
+        return lon_edges, lat_edges
+
+    @staticmethod
+    def near_edge(values, edges):
+        """
+        判断各值是否与某个边界的距离小于EDGE_EPSILON
+        """
+        index = np.searchsorted(edges, values)
+        lower = edges[np.clip(index - 1, 0, len(edges) - 1)]
+        upper = edges[np.clip(index, 0, len(edges) - 1)]
+        return (np.abs(values - lower) < EDGE_EPSILON) | (np.abs(values - upper) < EDGE_EPSILON)
+
+    def reduce_trajectory(self, vehicle_history):
+        """
+        匹配前精简轨迹点。匹配结果只取决于轨迹经过了哪些站点，以下精简不会改变结果：
+        1. 去除坐标完全相同的重复点（包括停车时的重复上报）
+        2. 转换坐标后去除在所有站点范围外包矩形以外的点
+        3. 站点范围的经纬度边界把平面划分为若干格子，同一格子中的点命中的站点完全相同，每个格子只保留第一个点；
+           靠近边界的点不参与合并
+        :return: (GCJ经度数组, GCJ纬度数组, 各阶段后的点数列表)，保持原始顺序
+        """
+        lngs = vehicle_history['经度'].to_numpy(dtype=np.float64)
+        lats = vehicle_history['纬度'].to_numpy(dtype=np.float64)
+        counts = [len(lngs)]
+
+        # 去除重复点
+        _, first_index = np.unique(lngs + 1j * lats, return_index=True)
+        first_index.sort()
+        lngs, lats = lngs[first_index], lats[first_index]
+        counts.append(len(lngs))
+
+        gcj_lat, gcj_lng = wgs2gcj_arrays(lats, lngs)
+        if len(self.lon_edges) == 0:
+            return gcj_lng[:0], gcj_lat[:0], counts + [0, 0]
+
+        # 去除站点范围外包矩形以外的点，边界放宽EDGE_EPSILON，避免边界的浮点误差误删命中站点的点
+        inside = ((gcj_lng > self.lon_edges[0] - EDGE_EPSILON) & (gcj_lng < self.lon_edges[-1] + EDGE_EPSILON) &
+                  (gcj_lat > self.lat_edges[0] - EDGE_EPSILON) & (gcj_lat < self.lat_edges[-1] + EDGE_EPSILON))
+        gcj_lng, gcj_lat = gcj_lng[inside], gcj_lat[inside]
+        counts.append(len(gcj_lng))
+
+        # 同一格子中的点只保留第一个
+        cell = (np.searchsorted(self.lon_edges, gcj_lng).astype(np.int64) * (len(self.lat_edges) + 1) +
+                np.searchsorted(self.lat_edges, gcj_lat))
+        on_edge = self.near_edge(gcj_lng, self.lon_edges) | self.near_edge(gcj_lat, self.lat_edges)
+        _, first_index = np.unique(cell[~on_edge], return_index=True)
+        keep = np.concatenate([np.flatnonzero(~on_edge)[first_index], np.flatnonzero(on_edge)])
+        keep.sort()
+        gcj_lng, gcj_lat = gcj_lng[keep], gcj_lat[keep]
+        counts.append(len(gcj_lng))
+        return gcj_lng, gcj_lat, counts
+
+    def query_stations(self, lon, lat):
+        """
+        查询位置点匹配范围内的所有站点，只检查所在格子及其相邻的8个格子。
+        结果按站点在stations_dict中的顺序返回，与逐站点遍历的匹配顺序保持一致
+        """
+        cell_x, cell_y = RouteMatcher.grid_cell(lon, lat)
+        matched_stations = []
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                for station_order, station_name in self.station_grid.get((cell_x + dx, cell_y + dy), ()):
+                    station_position = self.stations_dict[station_name]['position']
+                    if abs(lon - station_position[0]) < STATION_TOLERANCE and abs(lat - station_position[1]) < STATION_TOLERANCE:
+                        matched_stations.append((station_order, station_name))
+        matched_stations.sort()
+        return [station_name for _, station_name in matched_stations]
+
     def match_route(self, vehicle_history):
         """
             匹配所有关联的公交路线，并计算每个公交路线的匹配率
@@ -99,22 +228,34 @@ class RouteMatcher:
         route_match_counts = {}
         matched_stations_per_route = {route_name: set() for route_name in self.total_stations_per_route}
 
+        # 未获取到轨迹数据
+        if vehicle_history.empty:
+            return None,None,None
+
+        if self.early_stop:
+            top_route, route_match_rates, route_coverage, complete = self.match_route_streaming(vehicle_history)
+            if not complete:
+                # 提前结束时只有最佳路线的匹配率是完整的，不返回其他路线不完整的匹配率
+                route_match_rates = {top_route: route_match_rates[top_route]}
+            return top_route, route_match_rates, route_coverage
+
+        # 整条轨迹一次性完成坐标转换，并精简不影响匹配结果的轨迹点
+        gcj_lons, gcj_lats, counts = self.reduce_trajectory(vehicle_history)
+        print(f"轨迹点精简：{counts[0]}个 -> 去重后{counts[1]}个({counts[1] / counts[0]:.1%}) -> "
+              f"范围内{counts[2]}个({counts[2] / max(counts[1], 1):.1%}) -> 合并后{counts[3]}个"
+              f"({counts[3] / max(counts[2], 1):.1%})")
+
         # 遍历转换坐标后的每个位置点
-        for index, row in vehicle_history.iterrows():
-            # 对当前行的经纬度进行坐标转换
-            gcj_lon, gcj_lat = self.wgs84_to_gcj02(row['纬度'], row['经度'])
-
-            for station_name, data in self.stations_dict.items():
-                station_position = data['position']
-                # 使用转换后的坐标来比较距离
-                if abs(gcj_lon - station_position[0]) < 0.005 and abs(gcj_lat - station_position[1]) < 0.005:
-                    # 遍历每个站点关联的所有路线
-                    for route_name in data['routes']:
-                        if station_name not in matched_stations_per_route[route_name]:
-                            # 如果站点不在路线的已匹配站点集合中，增加匹配次数
-                            route_match_counts[route_name] = route_match_counts.get(route_name, 0) + 1
-                            # 将站点添加到路线的已匹配站点集合中
-                            matched_stations_per_route[route_name].add(station_name)
+        for gcj_lon, gcj_lat in zip(gcj_lons.tolist(), gcj_lats.tolist()):
+            # 通过网格索引查找匹配范围内的站点
+            for station_name in self.query_stations(gcj_lon, gcj_lat):
+                # 遍历每个站点关联的所有路线
+                for route_name in self.stations_dict[station_name]['routes']:
+                    if station_name not in matched_stations_per_route[route_name]:
+                        # 如果站点不在路线的已匹配站点集合中，增加匹配次数
+                        route_match_counts[route_name] = route_match_counts.get(route_name, 0) + 1
+                        # 将站点添加到路线的已匹配站点集合中
+                        matched_stations_per_route[route_name].add(station_name)
 
         # 计算匹配率
         route_match_rates = {}
@@ -126,13 +267,144 @@ class RouteMatcher:
         if not route_match_rates:
             return None,None,None
 
+        return self.select_top_route(route_match_rates),route_match_rates,self.route_coverage
+
+    def select_top_route(self, route_match_rates):
+        """
+        从各路线的匹配率中选出最佳路线
+        """
         # 筛选出匹配率在0.95以上的所有路线
-        matched_routes = [route for route, rate in route_match_rates.items() if rate >= 0.95]
+        matched_routes = [route for route, rate in route_match_rates.items() if rate >= MATCH_RATE_THRESHOLD]
         if not matched_routes:  # 如果没有匹配率在0.95以上的路线，则保留原有逻辑
             top_match_rate = max(route_match_rates.values())
             matched_routes = [route for route, rate in route_match_rates.items() if rate == top_match_rate]
 
         # 从这些路线中选择路径覆盖度最高的路线
-        top_route = max(matched_routes, key=lambda route: self.route_coverage[route])
+        return max(matched_routes, key=lambda route: self.route_coverage[route])
+
+    def build_route_stations(self):
+        """
+        流式匹配使用的数据：各路线的站点名称、站点坐标，以及按路径覆盖度从高到低排列的路线
+        """
+        route_station_names = defaultdict(list)
+        for station_name, data in self.stations_dict.items():
+            for route_name in data['routes']:
+                route_station_names[route_name].append(station_name)
+        route_stations = {}
+        for route_name in self.total_stations_per_route:
+            names = route_station_names.get(route_name, [])
+            positions = np.array([self.stations_dict[name]['position'] for name in names],
+                                 dtype=np.float64).reshape(-1, 2)
+            route_stations[route_name] = (names, {name: i for i, name in enumerate(names)}, positions)
+        routes_by_coverage = sorted(self.total_stations_per_route, key=lambda route: self.route_coverage[route],
+                                    reverse=True)
+        return route_stations, routes_by_coverage
+
+    def can_reach_threshold(self, route_name, match_count, matched_mask, remaining_bounds):
+        """
+        判断路线利用剩余轨迹点是否还可能达到匹配率阈值：
+        剩余轨迹点外包矩形匹配范围内的未匹配站点全部命中时的匹配率作为上限
+        """
+        _, _, positions = self.route_stations[0][route_name]
+        min_lon, max_lon, min_lat, max_lat = remaining_bounds
+        # 边界放宽EDGE_EPSILON，避免浮点误差低估上限
+        margin = STATION_TOLERANCE + EDGE_EPSILON
+        reachable = ((positions[:, 0] > min_lon - margin) & (positions[:, 0] < max_lon + margin) &
+                     (positions[:, 1] > min_lat - margin) & (positions[:, 1] < max_lat + margin))
+        if matched_mask is not None:
+            reachable &= ~matched_mask
+        upper_bound = match_count + int(np.count_nonzero(reachable))
+        return upper_bound / self.total_stations_per_route[route_name] >= MATCH_RATE_THRESHOLD
+
+    def match_route_streaming(self, vehicle_history, chunk_size=STREAM_CHUNK_SIZE):
+        """
+        流式匹配：按批处理轨迹点并累计各路线的匹配次数。当已有路线达到匹配率阈值，
+        且路径覆盖度不低于它的其他路线利用剩余轨迹点都不可能达到阈值时，最佳路线已经确定，提前结束。
+        结束后补全最佳路线在剩余轨迹点上的匹配，最佳路线及其匹配率与完整匹配一致
+        :return: (最佳路线, 各路线匹配率, 各路线路径覆盖度, 匹配率是否完整)，
+                 提前结束时除最佳路线外其他路线的匹配率只统计了已处理的轨迹点，是否完整为False
+        """
+        if vehicle_history.empty:
+            return None, None, None, True
+        if self.route_stations is None:
+            self.route_stations = self.build_route_stations()
+        route_stations, routes_by_coverage = self.route_stations
+
+        gcj_lons, gcj_lats, _ = self.reduce_trajectory(vehicle_history)
+        total_points = len(gcj_lons)
+        if total_points == 0:
+            return None, None, None, True
+        # 每个位置之后剩余轨迹点的外包矩形
+        suffix_min_lon = np.minimum.accumulate(gcj_lons[::-1])[::-1]
+        suffix_max_lon = np.maximum.accumulate(gcj_lons[::-1])[::-1]
+        suffix_min_lat = np.minimum.accumulate(gcj_lats[::-1])[::-1]
+        suffix_max_lat = np.maximum.accumulate(gcj_lats[::-1])[::-1]
+
+        route_match_counts = {}
+        matched_stations_per_route = {route_name: set() for route_name in self.total_stations_per_route}
+        matched_masks = {}
+        lon_list, lat_list = gcj_lons.tolist(), gcj_lats.tolist()
+        top_route = None
+        position = 0
+        while position < total_points:
+            end = min(position + chunk_size, total_points)
+            for gcj_lon, gcj_lat in zip(lon_list[position:end], lat_list[position:end]):
+                for station_name in self.query_stations(gcj_lon, gcj_lat):
+                    for route_name in self.stations_dict[station_name]['routes']:
+                        if station_name not in matched_stations_per_route[route_name]:
+                            route_match_counts[route_name] = route_match_counts.get(route_name, 0) + 1
+                            matched_stations_per_route[route_name].add(station_name)
+                            names, name_index, _ = route_stations[route_name]
+                            if route_name not in matched_masks:
+                                matched_masks[route_name] = np.zeros(len(names), dtype=bool)
+                            matched_masks[route_name][name_index[station_name]] = True
+            position = end
+            if position >= total_points:
+                break
+
+            # 当前达到阈值的路线中路径覆盖度最高的路线
+            leaders = [route for route, count in route_match_counts.items()
+                       if count / self.total_stations_per_route[route] >= MATCH_RATE_THRESHOLD]
+            if not leaders:
+                continue
+            leader = max(leaders, key=lambda route: self.route_coverage[route])
+            leader_coverage = self.route_coverage[leader]
+            remaining_bounds = (suffix_min_lon[position], suffix_max_lon[position],
+                                suffix_min_lat[position], suffix_max_lat[position])
+            threatened = False
+            for route_name in routes_by_coverage:
+                if self.route_coverage[route_name] < leader_coverage:
+                    break
+                if route_name != leader and self.can_reach_threshold(
+                        route_name, route_match_counts.get(route_name, 0), matched_masks.get(route_name),
+                        remaining_bounds):
+                    threatened = True
+                    break
+            if not threatened:
+                top_route = leader
+                break
+
+        if top_route is None:
+            # 完整处理了所有轨迹点
+            route_match_rates = {route_name: match_count / self.total_stations_per_route[route_name]
+                                 for route_name, match_count in route_match_counts.items()}
+            if not route_match_rates:
+                return None, None, None, True
+            return self.select_top_route(route_match_rates), route_match_rates, self.route_coverage, True
+
+        # 补全最佳路线在剩余轨迹点上命中的站点
+        names, _, positions = route_stations[top_route]
+        unmatched = np.flatnonzero(~matched_masks[top_route])
+        remaining_lons, remaining_lats = gcj_lons[position:], gcj_lats[position:]
+        extra = 0
+        for index in unmatched:
+            station_lon, station_lat = positions[index]
+            if np.any((np.abs(remaining_lons - station_lon) < STATION_TOLERANCE) &
+                      (np.abs(remaining_lats - station_lat) < STATION_TOLERANCE)):
+                extra += 1
+        route_match_counts[top_route] += extra
 
-        return top_route,route_match_rates,self.route_coverage
+        route_match_rates = {route_name: match_count / self.total_stations_per_route[route_name]
+                             for route_name, match_count in route_match_counts.items()}
+        print(f"提前结束匹配：处理{position}/{total_points}个轨迹点后确定最佳路线{top_route}")
+        return top_route, route_match_rates, self.route_coverage, False
@@ -0,0 +1,68 @@
+import os
+import pickle
+
+#快照格式版本，快照内容结构变化时需递增，旧版本快照将被忽略
+SNAPSHOT_VERSION = 1
+
+
+class RouteSnapshot:
+    """
+    城市线路模型的本地快照，以线路表的校验和作为版本，线路表变化后自动重建
+    """
+    def __init__(self, snapshot_dir):
+        self.snapshot_dir = snapshot_dir
+        os.makedirs(snapshot_dir, exist_ok=True)
+
+    @staticmethod
+    def table_checksum(cursor, table_name):
+        """
+        获取线路表的校验和，表不存在时返回None
+        """
+        cursor.execute(f"CHECKSUM TABLE {table_name}")
+        row = cursor.fetchone()
+        if row is None or row[1] is None:
+            return None
+        return str(row[1])
+
+    def get_path(self, city):
+        return os.path.join(self.snapshot_dir, f"route_model_{city.lower()}.pkl")
+
+    def load(self, city, checksum):
+        """
+        读取快照，快照不存在、版本不符或校验和不一致时返回None
+        :return: (stations_dict, total_stations_per_route, route_coverage)
+        """
+        path = self.get_path(city)
+        if checksum is None or not os.path.exists(path):
+            return None
+        try:
+            with open(path, 'rb') as f:
+                snapshot = pickle.load(f)
+        except Exception as e:
+            print(f"读取线路快照失败：{path}: {e}")
+            return None
+        if snapshot.get('version') != SNAPSHOT_VERSION or snapshot.get('checksum') != checksum:
+            return None
+        return snapshot['stations_dict'], snapshot['total_stations_per_route'], snapshot['route_coverage']
+
+    def save(self, city, checksum, stations_dict, total_stations_per_route, route_coverage):
+        """
+        保存快照，先写临时文件再替换，避免并发读取到不完整的快照
+        """
+        if checksum is None:
+            return
+        snapshot = {
+            'version': SNAPSHOT_VERSION,
+            'checksum': checksum,
+            'stations_dict': stations_dict,
+            'total_stations_per_route': total_stations_per_route,
+            'route_coverage': route_coverage
+        }
+        path = self.get_path(city)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, 'wb') as f:
+                pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"保存线路快照失败：{path}: {e}")
@@ -0,0 +1,88 @@
+import time
+import json
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+#接口未返回有效期时，鉴权的默认有效期（秒）
+DEFAULT_TOKEN_TTL = 3600
+#鉴权提前刷新的时间（秒），避免请求途中过期
+TOKEN_REFRESH_MARGIN = 60
+#需要退避重试的响应状态码
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+
+class SdkClient:
+    """
+    SDK接口客户端，多线程共用一个连接池，鉴权在有效期内复用，过期后只刷新一次
+    """
+    def __init__(self, config, pool_size=16, retries=3, backoff_factor=0.5):
+        self.config = config
+        self.session = requests.Session()
+        retry = Retry(total=retries, backoff_factor=backoff_factor,
+                      status_forcelist=RETRY_STATUS,
+                      allowed_methods=frozenset(['GET']))
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.lock = threading.Lock()
+        self.token = None
+        self.expires_at = 0
+        self.login_count = 0
+
+    def login(self):
+        """获取SDK接口调用的鉴权"""
+        params = {
+            "username": self.config['SDK']['USERNAME'],
+            "password": self.config['SDK']['PASSWORD']
+        }
+        response = self.session.post(self.config['SDK']['LOGIN_URL'], data=params)
+        if response.status_code != 200:
+            raise Exception("获取Authorization失败")
+        data = json.loads(response.text)["data"]
+        self.login_count += 1
+        expires_in = float(data.get("expires_in") or DEFAULT_TOKEN_TTL)
+        return data["token_type"] + " " + data["access_token"], time.time() + expires_in
+
+    def get_token(self):
+        """
+        获取有效的鉴权，过期或被判定失效时重新登录
+        """
+        with self.lock:
+            if self.token is None or time.time() >= self.expires_at - TOKEN_REFRESH_MARGIN:
+                self.token, self.expires_at = self.login()
+            return self.token
+
+    def invalidate_token(self, token):
+        """
+        标记鉴权失效。多个线程同时发现同一鉴权失效时，只有第一个会触发重新登录
+        """
+        with self.lock:
+            if self.token == token:
+                self.token = None
+
+    def get_json(self, url, params=None):
+        """
+        调用SDK的GET接口，鉴权失效时刷新后重试一次
+        :return: 解析后的json数据，失败时返回None
+        """
+        for attempt in range(2):
+            token = self.get_token()
+            headers = {
+                "Content-Type": "application/json;charset=UTF-8",
+                "Authorization": token
+            }
+            try:
+                response = self.session.get(url, params=params, headers=headers)
+            except requests.RequestException as e:
+                print(f"调用接口：{url} 失败: {str(e)}")
+                return None
+            if response.status_code == 401 and attempt == 0:
+                self.invalidate_token(token)
+                continue
+            if response.status_code != 200:
+                print(f"调用接口：{url} 失败: {response.status_code}")
+                return None
+            return json.loads(response.text)
+        return None
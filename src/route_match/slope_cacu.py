@@ -2,11 +2,13 @@
 # 日 期： 2024/1/4
 
 import pandas as pd
+import numpy as np
 import math
 import datetime
-from scipy.spatial import cKDTree
 from database_manager import DatabaseManager
+from slope_profile import slope_profile
 import json
+import hashlib
 import requests
 
 class PositionUtil:
@@ -30,6 +32,43 @@ class PositionUtil:
         s = round(s * 10000) / 10000  # 米转千米
         return s
 
+    @staticmethod
+    def get_distance_array(lat1, lng1, lat2, lng2):
+        """ 批量计算GPS坐标点之间的距离，与get_distance结果一致 """
+        rad_lat1 = PositionUtil.rad(lat1)
+        rad_lat2 = PositionUtil.rad(lat2)
+        a = rad_lat1 - rad_lat2
+        b = PositionUtil.rad(lng1) - PositionUtil.rad(lng2)
+        s = 2 * np.arcsin(np.sqrt(np.sin(a / 2) ** 2 +
+                                  np.cos(rad_lat1) * np.cos(rad_lat2) * np.sin(b / 2) ** 2))
+        s = s * PositionUtil.EARTH_RADIUS
+        s = np.round(s * 10000) / 10000  # 米转千米
+        return s
+
+    @staticmethod
+    def densify(lngArr, latArr, plot_distance):
+        """
+        按固定间距对折线整体插值：长于间距的线段等分插值，较短的线段保留起点，重合点丢弃
+        :param plot_distance: 插值间距（千米）
+        :return: 插值后的经度、纬度数组
+        """
+        lngArr = np.asarray(lngArr, dtype=np.float64)
+        latArr = np.asarray(latArr, dtype=np.float64)
+        dist = PositionUtil.get_distance_array(latArr[:-1], lngArr[:-1], latArr[1:], lngArr[1:])
+
+        # 每条线段输出的点数
+        num = np.where(dist > plot_distance, (dist / plot_distance).astype(np.int64), (dist != 0).astype(np.int64))
+        segment = np.repeat(np.arange(len(num)), num)
+        # 每个插值点在所属线段中的序号
+        step = np.arange(len(segment)) - np.repeat(np.cumsum(num) - num, num)
+        divisor = np.maximum(num, 1)
+        d_lng = (lngArr[1:] - lngArr[:-1]) / divisor
+        d_lat = (latArr[1:] - latArr[:-1]) / divisor
+
+        lngArrPlot = np.append(lngArr[:-1][segment] + d_lng[segment] * step, lngArr[-1])
+        latArrPlot = np.append(latArr[:-1][segment] + d_lat[segment] * step, latArr[-1])
+        return lngArrPlot, latArrPlot
+
     @staticmethod
     def linear_plot(a1, a2, num):
         """ 线性插值 """
@@ -39,22 +78,18 @@ class PositionUtil:
             linear_arr.append(a1 + d * i)
         return linear_arr
 
-def get_b(x, y, j):
-    """ 使用最小二乘法计算线性回归的斜率（b值） """
-    xp = sum(x[:j]) / j
-    yp = sum(y[:j]) / j
-
-    zpp = sum((xi - xp) * (yi - yp) for xi, yi in zip(x[:j], y[:j]))
-    xxp = sum((xi - xp) ** 2 for xi in x[:j])
-
-    b = zpp / xxp if xxp != 0 else 0
-    return b
+#高德公交路线规划接口
+TRANSIT_URL = 'https://restapi.amap.com/v3/direction/transit/integrated'
+#复用连接的HTTP会话
+AMAP_SESSION = requests.Session()
 
 class SlopeCacu:
-    def __init__(self, config, db_config,col_data):
+    def __init__(self, config, db_config,elevation_index, polyline_cache=None, result_cache=None):
         self.config = config
         self.db_config = db_config
-        self.col_data = col_data
+        self.elevation_index = elevation_index
+        self.polyline_cache = polyline_cache
+        self.result_cache = result_cache
 
     def extract_polyline_from_route(self, route_data, target_bus_route_name):
         """
@@ -99,7 +134,17 @@ class SlopeCacu:
         :param target_bus_route_name: The name of the target bus route.
         :return: A list of polyline data for the specified bus route, or an error message.
         """
-        url = 'https://restapi.amap.com/v3/direction/transit/integrated'
+        if self.polyline_cache is None:
+            return self.fetch_polyline(api_key, origin, destination, city, target_bus_route_name)
+        return self.polyline_cache.get_or_fetch(
+            city, origin, destination, target_bus_route_name,
+            lambda: self.fetch_polyline(api_key, origin, destination, city, target_bus_route_name))
+
+    def fetch_polyline(self, api_key, origin, destination, city, target_bus_route_name):
+        """
+        Requests the transit API and extracts polyline data, bypassing the cache.
+        """
+        url = self.config['key'].get('TRANSIT_URL', TRANSIT_URL)
         params = {
             'key': api_key,
             'origin': origin,
@@ -109,7 +154,7 @@ class SlopeCacu:
             'strategy': '0'
         }
 
-        response = requests.get(url, params=params)
+        response = AMAP_SESSION.get(url, params=params)
         if response.status_code == 200:
             route_data = response.json()
 
@@ -120,12 +165,21 @@ class SlopeCacu:
 
         return f"Request failed, status code: {response.status_code}"
 
-    def get_route_data(self, city_name,line_name):
+    def get_route_row(self, city_name, line_name):
         db_client = DatabaseManager(self.db_config,city_name)
         line_GPS_data = db_client.get_line_GPS("bus_routes", lineName=line_name)
-        line_GPS_data = line_GPS_data[0]
+        return line_GPS_data[0]
+
+    @staticmethod
+    def route_endpoints(line_GPS_data):
         origin = str(line_GPS_data["start_station_longitude"])+','+str(line_GPS_data["start_station_latitude"])
         destination = str(line_GPS_data["end_station_longitude"])+','+str(line_GPS_data["end_station_latitude"])
+        return origin, destination
+
+    def get_route_data(self, city_name,line_name, line_GPS_data=None):
+        if line_GPS_data is None:
+            line_GPS_data = self.get_route_row(city_name, line_name)
+        origin, destination = self.route_endpoints(line_GPS_data)
         lngArr, latArr = self.get_and_extract_polyline(self.config['key']['API_KEY'], origin, destination, city_name, line_name)
         if not lngArr or not latArr:
             gps_col = 'via_stations'
@@ -141,132 +195,67 @@ class SlopeCacu:
                 latArr.append(station['latitude'])
         return lngArr, latArr
 
-    def get_map(self,lngArr,latArr):
-        # 计算经纬度的最大最小值
-        min_lng, max_lng = min(lngArr), max(lngArr)
-        min_lat, max_lat = min(latArr), max(latArr)
-
-        # col_data = pd.read_parquet(self.config['filepath']['parquet_path'], columns=['经度', '纬度', '高程'])
-        # 筛选落在矩形区域内的点
-        filtered_data = self.col_data[(self.col_data['经度'] >= min_lng) & (self.col_data['经度'] <= max_lng) &
-                                 (self.col_data['纬度'] >= min_lat) & (self.col_data['纬度'] <= max_lat)]
-
-        lngArr1 = filtered_data['经度'].tolist()  # 列表C
-        latArr1 = filtered_data['纬度'].tolist()  # 列表D
-        altitudeArr1 = filtered_data["高程"].tolist()  # 列表E
-
-        return lngArr1,latArr1,altitudeArr1
-
-    def interpolate_and_match(self, lngArr, latArr, lngArr1,latArr1,altitudeArr1):
-        lngArrPlot = []  # 列表A1
-        latArrPlot = []  # 列表B1
-
-        for i in range(len(lngArr) - 1):
-            lng1 = float(lngArr[i])
-            lat1 = float(latArr[i])
-            lng2 = float(lngArr[i + 1])
-            lat2 = float(latArr[i + 1])
-
-            dist1 = PositionUtil.get_distance(lat1, lng1, lat2, lng2)
-
-            PLOTDISTANCE = 0.05
-            if dist1 > PLOTDISTANCE:
-                num = int(dist1 / PLOTDISTANCE)
-                latPlot = PositionUtil.linear_plot(lat1, lat2, num)
-                lngPlot = PositionUtil.linear_plot(lng1, lng2, num)
-
-                lngArrPlot.extend(lngPlot)
-                latArrPlot.extend(latPlot)
-            elif dist1 != 0:
-                lngArrPlot.append(lng1)
-                latArrPlot.append(lat1)
-
-        lngArrPlot.append(lng2)
-        latArrPlot.append(lat2)
+    def interpolate_and_match(self, lngArr, latArr):
+        # 每50米插值一个点
+        PLOTDISTANCE = 0.05
+        lngArrPlot, latArrPlot = PositionUtil.densify(lngArr, latArr, PLOTDISTANCE)
 
         # 高程匹配
-        # 使用 k-d树进行高程匹配
-        lng_lat_arr1 = list(zip(lngArr1, latArr1))  # 将经度和纬度合并为元组列表
-        tree = cKDTree(lng_lat_arr1)  # 创建 k-d树
-
-        newAltitudeArr = []
-        for lng, lat in zip(lngArrPlot, latArrPlot):
-            _, index = tree.query((lng, lat), k=1)  # 查询最近的点
-            newAltitudeArr.append(altitudeArr1[index])
+        # 使用城市高程数据加载时建立的k-d树，一次查询所有插值点最近的高程点
+        newAltitudeArr = self.elevation_index.query(lngArrPlot, latArrPlot)
 
         return lngArrPlot, latArrPlot,newAltitudeArr
 
     def calculate_slope(self, lngArrPlot, latArrPlot, newAltitudeArr):
-        # 每x米线性拟合一次坡度
-        PLOT_DISTANCE = 100
-        PLOT_NUM = 4
-        miles = 0
-        sumD = 0
-        gradArr = []
-        mileArr = []
-        gpsArr = []
-        x = []
-        y = []
-        slope_result = []
-
-        for i in range(len(latArrPlot) - 1):
-            lng1 = lngArrPlot[i]
-            lat1 = latArrPlot[i]
-            lng2 = lngArrPlot[i + 1]
-            lat2 = latArrPlot[i + 1]
-            dist1 = PositionUtil.get_distance(lat1, lng1, lat2, lng2)
-            miles += dist1
-            x.append(miles * 1000)
-            y.append(newAltitudeArr[i + 1])
-            sumD += dist1 * 1000
-
-            if sumD > PLOT_DISTANCE and len(x) > PLOT_NUM:
-                f = get_b(x, y, len(x))
-                gradArr.append(f)
-                mileArr.append(miles)
-                gpsArr.append(f"{lng2},{lat2}")
-                x = []
-                y = []
-                sumD = 0
-
-        # 输出阈值坡度及相关信息
-        gradArr1 = []
-        mileArr1 = []
-        gpsArr1 = []
-        preMile = 0
-        gradMax = 0
-        # print("最大坡度 最大坡度距离 当前平均坡度 持续距离 起始距离 结束距离 GPS位置")
-        # print("最大坡度 持续距离 GPS位置")
-        for i in range(1, len(gradArr)):
-            GRAD = 0.03
-            if gradArr[i] * gradArr[i - 1] < 0:
-                if gradMax >= GRAD or gradMax <= -GRAD:
-                    index = gradArr.index(gradMax)
-                    gradMaxMile = mileArr[index] - mileArr[index - 1]
-                    gradSum = gradArr1[0] * (mileArr1[0] - preMile)
-                    distance = mileArr[i - 1] - preMile
-                    for j in range(1, len(mileArr1)):
-                        gradSum += (mileArr1[j] - mileArr1[j - 1]) * gradArr1[j]
-                    # print(gradMax, distance,gpsArr[index])
-                    slope_result.append(["坡度:"+str(gradMax), "持续距离:"+str(distance),"GPS:"+gpsArr[index]])
-
-                gradArr1 = []
-                mileArr1 = []
-                gpsArr1 = []
-                gradMax = 0
-                preMile = mileArr[i - 1]
-
-            gradArr1.append(gradArr[i])
-            mileArr1.append(mileArr[i])
-            gpsArr1.append(gpsArr[i])
-            if abs(gradMax) < abs(gradArr[i]):
-                gradMax = gradArr[i]
+        """
+        计算路线坡度，返回最大坡度超过阈值的坡段
+        :return: SlopeSegment列表
+        """
+        lngArrPlot = np.asarray(lngArrPlot, dtype=np.float64)
+        latArrPlot = np.asarray(latArrPlot, dtype=np.float64)
+        step_distance = PositionUtil.get_distance_array(latArrPlot[:-1], lngArrPlot[:-1], latArrPlot[1:], lngArrPlot[1:])
+        return slope_profile(lngArrPlot, latArrPlot, newAltitudeArr, step_distance)
 
-        return slope_result
+    def geometry_version(self, city_name, line_name, line_GPS_data):
+        """
+        不请求高德接口，根据线路记录和折线缓存得到路线几何的版本：
+        线路记录中的起终点和途经站点，加上未过有效期的折线缓存条目的获取时间。
+        未启用折线缓存时只使用线路记录
+        :return: 版本字符串，折线缓存中没有有效条目时返回None
+        """
+        origin, destination = self.route_endpoints(line_GPS_data)
+        digest = hashlib.sha1(json.dumps([origin, destination, line_GPS_data.get('via_stations')],
+                                         ensure_ascii=False, default=str).encode('utf-8')).hexdigest()
+        if self.polyline_cache is None:
+            return digest
+        polyline_version = self.polyline_cache.version(city_name, origin, destination, line_name)
+        if polyline_version is None:
+            return None
+        return f"{digest}:{polyline_version}"
 
     def process_route(self, city_name,line_name):
-        lngArr, latArr = self.get_route_data(city_name,line_name)
-        lngArr1,latArr1,altitudeArr1=self.get_map(lngArr, latArr)
-        lngArrPlot, latArrPlot,newAltitudeArr = self.interpolate_and_match(lngArr, latArr,lngArr1,latArr1,altitudeArr1)
+        line_GPS_data = self.get_route_row(city_name, line_name)
+
+        # 路线几何和高程数据都未变化时直接返回缓存的坡度结果，命中时不请求高德接口
+        cache_key = None
+        if self.result_cache is not None:
+            version = self.geometry_version(city_name, line_name, line_GPS_data)
+            if version is not None:
+                cache_key = (city_name, line_name, version, self.elevation_index.version)
+                slope_result = self.result_cache.get(cache_key)
+                if slope_result is not None:
+                    return slope_result
+
+        lngArr, latArr = self.get_route_data(city_name,line_name, line_GPS_data)
+        lngArrPlot, latArrPlot,newAltitudeArr = self.interpolate_and_match(lngArr, latArr)
         slope_result = self.calculate_slope(lngArrPlot, latArrPlot, newAltitudeArr)
+
+        if self.result_cache is not None:
+            if cache_key is None:
+                # 折线刚获取并写入缓存，重新读取版本
+                version = self.geometry_version(city_name, line_name, line_GPS_data)
+                if version is not None:
+                    cache_key = (city_name, line_name, version, self.elevation_index.version)
+            if cache_key is not None:
+                self.result_cache.put(cache_key, slope_result)
         return slope_result
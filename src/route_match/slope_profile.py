@@ -0,0 +1,102 @@
+from collections import namedtuple
+import numpy as np
+
+# 每x米线性拟合一次坡度
+PLOT_DISTANCE = 100
+# 每次拟合至少需要的点数（不含）
+PLOT_NUM = 4
+# 输出的坡度阈值
+GRAD = 0.03
+# 绝对值小于该值的斜率视为0，平坦窗口的计算误差不同求和顺序下正负号不同，会影响坡段划分
+SLOPE_EPSILON = 1e-12
+
+# 坡段：最大坡度、持续距离（千米）、最大坡度处的经纬度
+SlopeSegment = namedtuple('SlopeSegment', ['gradient', 'distance', 'lng', 'lat'])
+
+
+def split_windows(step_distance):
+    """
+    按累计距离划分拟合窗口，距离超过PLOT_DISTANCE且点数超过PLOT_NUM时结束一个窗口
+    :param step_distance: 相邻插值点之间的距离（米）
+    :return: 各窗口最后一个点的下标
+    """
+    window_ends = []
+    sumD = 0
+    count = 0
+    for i, dist in enumerate(step_distance.tolist()):
+        sumD += dist
+        count += 1
+        if sumD > PLOT_DISTANCE and count > PLOT_NUM:
+            window_ends.append(i)
+            sumD = 0
+            count = 0
+    return np.array(window_ends, dtype=np.int64)
+
+
+def window_slopes(x, y, window_ends):
+    """
+    用最小二乘法批量计算各窗口的线性回归斜率
+    :param x: 里程（米）
+    :param y: 高程
+    :param window_ends: 各窗口最后一个点的下标
+    :return: 各窗口的斜率，绝对值小于SLOPE_EPSILON的记为0
+    """
+    if len(window_ends) == 0:
+        return np.zeros(0)
+    x = x[:window_ends[-1] + 1]
+    y = y[:window_ends[-1] + 1]
+    starts = np.concatenate(([0], window_ends[:-1] + 1))
+    counts = window_ends - starts + 1
+
+    xp = np.add.reduceat(x, starts) / counts
+    yp = np.add.reduceat(y, starts) / counts
+    xc = x - np.repeat(xp, counts)
+    yc = y - np.repeat(yp, counts)
+    zpp = np.add.reduceat(xc * yc, starts)
+    xxp = np.add.reduceat(xc * xc, starts)
+
+    slopes = np.zeros(len(counts))
+    np.divide(zpp, xxp, out=slopes, where=xxp != 0)
+    slopes[np.abs(slopes) < SLOPE_EPSILON] = 0
+    return slopes
+
+
+def find_peak_segments(gradArr, mileArr, lngArr, latArr):
+    """
+    按坡度正负号划分坡段，一次遍历找出最大坡度超过阈值的坡段
+    """
+    segments = []
+    preMile = 0
+    gradMax = 0
+    maxIndex = 0
+    for i in range(1, len(gradArr)):
+        if gradArr[i] * gradArr[i - 1] < 0:
+            if gradMax >= GRAD or gradMax <= -GRAD:
+                segments.append(SlopeSegment(gradMax, mileArr[i - 1] - preMile, lngArr[maxIndex], latArr[maxIndex]))
+            gradMax = 0
+            preMile = mileArr[i - 1]
+
+        if abs(gradMax) < abs(gradArr[i]):
+            gradMax = gradArr[i]
+            maxIndex = i
+    return segments
+
+
+def slope_profile(lngArrPlot, latArrPlot, altitudeArr, step_distance):
+    """
+    计算插值后路线的坡度剖面
+    :param step_distance: 相邻插值点之间的距离（千米）
+    :return: SlopeSegment列表
+    """
+    lngArrPlot = np.asarray(lngArrPlot, dtype=np.float64)
+    latArrPlot = np.asarray(latArrPlot, dtype=np.float64)
+    altitudeArr = np.asarray(altitudeArr, dtype=np.float64)
+
+    miles = np.cumsum(step_distance)
+    window_ends = split_windows(step_distance * 1000)
+    gradArr = window_slopes(miles * 1000, altitudeArr[1:], window_ends)
+
+    # 各窗口结束位置的里程和经纬度
+    point_index = window_ends + 1
+    return find_peak_segments(gradArr.tolist(), miles[window_ends].tolist(),
+                              lngArrPlot[point_index].tolist(), latArrPlot[point_index].tolist())
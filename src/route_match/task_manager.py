@@ -1,34 +1,96 @@
 # 作 者： Liuyaoqiu
 # 日 期： 2023/12/4
 
+import time
 import threading
 import queue
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+import aiohttp
+from match_pipeline import MatchPipeline
+from database_manager import MatchResultWriter
+from route_matcher import MATCH_RATE_THRESHOLD
 
-#匹配率阈值，大于等于该阈值时，认为是找到匹配路线
-MATCH_RATE_THRESHOLD = 0.95
+#异步获取数据时单次请求的超时时间（秒）
+FETCH_TIMEOUT = 120
+#本次运行中等待失败任务重试的最长时间（秒），超过时留给下次运行
+MAX_RETRY_WAIT = 600
 
 class TaskManager:
-    def __init__(self, data_fetcher, route_matcher):
+    def __init__(self, data_fetcher, route_matcher, ledger=None):
+        """
+        :param ledger: JobLedger，提供时记录每辆车的处理状态，重新运行时跳过已完成的车辆
+        """
         self.data_fetcher = data_fetcher
         self.route_matcher = route_matcher
+        self.ledger = ledger
+        # 当前任务的(城市, 日期)，用于记录台账
+        self.job = None
+
+    def job_city(self):
+        return self.job[0] if self.job else None
+
+    def record_fetched(self, vin):
+        if self.ledger:
+            self.ledger.mark_fetched(*self.job, vin)
+
+    def record_matched(self, vin, route_request):
+        if self.ledger:
+            self.ledger.mark_matched(*self.job, vin, route_request)
+
+    def record_failed(self, vin, error):
+        print(f"在处理 {vin} 时发生错误: {error}")
+        if self.ledger:
+            self.ledger.mark_failed(*self.job, vin, error)
+
+    def record_written(self, rows):
+        if self.ledger:
+            self.ledger.mark_written(*self.job, [row[0] for row in rows])
+
+    def record_write_failed(self, rows):
+        if self.ledger:
+            for row in rows:
+                self.ledger.mark_failed(*self.job, row[0], "写入数据库失败")
 
     def fetch_and_match(self, vin, start_time, end_time, result_queue):
         """
         获取车辆历史数据并进行路线匹配，将结果存储在结果队列中。
         """
-        vehicle_history = self.data_fetcher.fetch_vehicle_history(vin, start_time, end_time)
+        vehicle_history = self.data_fetcher.fetch_vehicle_history(vin, start_time, end_time, city=self.job_city())
+        self.record_fetched(vin)
+        self.match_history(vin, vehicle_history, result_queue)
+
+    def match_history(self, vin, vehicle_history, result_queue):
+        """
+        对已获取的车辆历史数据进行路线匹配，将结果存储在结果队列中。
+        """
         matched_route,route_match_rates,route_coverage = self.route_matcher.match_route(vehicle_history)
         if matched_route:
+            route_request = (vin, matched_route,route_match_rates[matched_route],route_coverage[matched_route])
+        else:
+            route_request = None
+        self.report_match(vin, route_request)
+        self.record_matched(vin, route_request)
+        if route_request:
+            result_queue.put(route_request)
+
+    @staticmethod
+    def report_match(vin, route_request):
+        """
+        输出单辆车的匹配结果
+        :param route_request: (vin, 最佳路线, 匹配率, 路径覆盖度)，未匹配到时为None
+        """
+        if route_request:
+            _, matched_route, match_rate, route_coverage = route_request
             # 判断最佳路线是否满足匹配阈值
-            if route_match_rates[matched_route] >= MATCH_RATE_THRESHOLD:
+            if match_rate >= MATCH_RATE_THRESHOLD:
                 print(
-                    f"{vin}最优路线：{matched_route}, 匹配率：{route_match_rates[matched_route]:.2%}, 路径覆盖度：{route_coverage[matched_route]:.2f}km")
+                    f"{vin}最优路线：{matched_route}, 匹配率：{match_rate:.2%}, 路径覆盖度：{route_coverage:.2f}km")
             else:
                 print(f"{vin}没有完全匹配的路线")
                 print(
-                    f"{vin}最近似路线：{matched_route}, 匹配率：{route_match_rates[matched_route]:.2%}, 路径覆盖度：{route_coverage[matched_route]:.2f}km")
-            result_queue.put((vin, matched_route,route_match_rates[matched_route],route_coverage[matched_route]))
+                    f"{vin}最近似路线：{matched_route}, 匹配率：{match_rate:.2%}, 路径覆盖度：{route_coverage:.2f}km")
         else:
             print(f"{vin}未找到匹配的路线")
 
@@ -44,53 +106,168 @@ class TaskManager:
                 self.fetch_and_match(vin, start_time, end_time, result_queue)
                 task_queue.task_done()
             except Exception as e:
-                print(f"在处理 {vin} 时发生错误: {e}")
+                self.record_failed(vin, e)
                 task_queue.task_done()
 
-    def manage_tasks(self, vehicle_ids, start_time, end_time,db_manager,city):
+    async def fetch_and_match_async(self, vehicle_ids, start_time, end_time, result_queue, concurrency):
         """
-        管理和分配任务到线程。
+        异步并发获取车辆历史数据，每辆车的数据获取后立即交给匹配线程处理。
+        :param concurrency: 同时进行的请求数量上限
         """
-        task_queue = queue.Queue()
-        result_queue = queue.Queue()
-        threads = []
+        loop = asyncio.get_running_loop()
+        semaphore = asyncio.Semaphore(concurrency)
+        # 匹配为CPU密集型操作，放在单独的线程中执行，避免阻塞事件循环
+        match_executor = ThreadPoolExecutor(max_workers=1)
+        connector = aiohttp.TCPConnector(limit=concurrency)
+        timeout = aiohttp.ClientTimeout(total=FETCH_TIMEOUT)
+
+        async def handle(vin):
+            try:
+                async with semaphore:
+                    vehicle_history = await self.data_fetcher.fetch_vehicle_history_async(
+                        session, vin, start_time, end_time, city=self.job_city())
+                self.record_fetched(vin)
+                await loop.run_in_executor(match_executor, self.match_history, vin, vehicle_history, result_queue)
+            except Exception as e:
+                self.record_failed(vin, e)
 
-        # 创建工作线程
-        for _ in range(2):  # 线程数量
-            thread = threading.Thread(target=self.worker, args=(task_queue, result_queue))
-            thread.start()
-            threads.append(thread)
+        try:
+            async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+                await asyncio.gather(*(handle(vin) for vin in vehicle_ids))
+        finally:
+            match_executor.shutdown(wait=True)
 
-        # 向队列中添加任务
-        for vin in vehicle_ids:
-            task_queue.put((vin, start_time, end_time))
+    def run_pipeline(self, vehicle_ids, start_time, end_time, writer, concurrency, match_workers):
+        """
+        使用流水线获取、匹配并保存结果：I/O线程获取数据，进程池匹配，结果线程在匹配完成后立即写入。
+        """
+        save_day = start_time.date()
 
-        # 停止信号
-        for _ in range(len(threads)):
-            task_queue.put(None)
+        def save_result(task, matched):
+            vin = task[0]
+            route_request = (vin,) + matched if matched else None
+            self.report_match(vin, route_request)
+            self.record_matched(vin, route_request)
+            if route_request:
+                self.save_result(writer, route_request, save_day)
 
-        task_queue.join()
+        pipeline = MatchPipeline(self.data_fetcher, self.route_matcher,
+                                 fetch_workers=concurrency, match_workers=match_workers, city=self.job_city())
+        pipeline.run(((vin, start_time, end_time) for vin in vehicle_ids), save_result,
+                     on_error=lambda task, error: self.record_failed(task[0], error),
+                     on_fetched=lambda task: self.record_fetched(task[0]))
 
-        # 等待所有任务完成
-        for thread in threads:
-            thread.join()
+    @staticmethod
+    def save_result(writer, route_request, save_day):
+        # 数据库保存vin、匹配路线、匹配率、覆盖路线、日期
+        vin, matched_route, match_rate, route_coverage = route_request
+        print("存储展示：",vin,matched_route,match_rate,route_coverage,save_day)
+        writer.add(vin, matched_route, match_rate, route_coverage, save_day)
 
+    def result_saver(self, result_queue, writer, save_day):
+        """
+        结果保存线程，匹配结果产生后立即交给批量写入器
+        """
+        while True:
+            route_request = result_queue.get()
+            if route_request is None:
+                break
+            try:
+                self.save_result(writer, route_request, save_day)
+            except Exception as e:
+                print(f"保存 {route_request[0]} 的匹配结果时发生错误: {e}")
+
+    def manage_tasks(self, vehicle_ids, start_time, end_time,db_manager,city, fetch_mode='thread', concurrency=2,
+                     match_workers=None, batch_size=500, max_retry_wait=MAX_RETRY_WAIT):
+        """
+        管理和分配任务到线程，匹配结果边产生边批量写入数据库。
+        使用台账时只处理未完成的车辆，失败的车辆在退避时间后重试。
+        :param fetch_mode: 'thread'为多线程同步获取，'async'为asyncio并发获取，'pipeline'为多进程匹配的流水线
+        :param concurrency: 线程数量或异步请求并发数量
+        :param match_workers: 流水线模式下的匹配进程数量，默认为CPU核数
+        :param batch_size: 每批写入数据库的结果数量
+        :param max_retry_wait: 使用台账时，本次运行中等待失败任务重试的最长时间（秒）
+        :return: 成功写入的结果数量
+        """
         # 计算前一天的日期
         # previous_day = datetime.now().date() - timedelta(days=1)
         save_day = start_time.date()
+        self.job = (city, save_day)
+        all_vehicle_ids = list(vehicle_ids)
+
+        with MatchResultWriter(db_manager, city, batch_size,
+                               on_written=self.record_written, on_failed=self.record_write_failed) as writer:
+            if self.ledger:
+                vehicle_ids, unwritten = self.ledger.prepare(city, save_day, all_vehicle_ids)
+                print(f"{city} {save_day}：共{len(all_vehicle_ids)}辆车，待处理{len(vehicle_ids)}辆，"
+                      f"已匹配待写入{len(unwritten)}辆")
+                # 上次运行已匹配但未写入的结果直接写入，无需重新获取
+                for route_request in unwritten:
+                    self.save_result(writer, route_request, save_day)
+
+            self.process_tasks(vehicle_ids, start_time, end_time, writer, save_day, fetch_mode, concurrency,
+                               match_workers, batch_size)
+
+            # 等待失败的车辆到达重试时间后重试，等待过久的留给下次运行
+            while self.ledger:
+                writer.flush()
+                next_retry_at = self.ledger.next_retry_at(city, save_day)
+                if next_retry_at is None or next_retry_at - time.time() > max_retry_wait:
+                    break
+                time.sleep(max(0, next_retry_at - time.time()))
+                retry_ids = self.ledger.runnable(city, save_day, all_vehicle_ids)
+                print(f"{city} {save_day}：重试{len(retry_ids)}辆车")
+                self.process_tasks(retry_ids, start_time, end_time, writer, save_day, fetch_mode, concurrency,
+                                   match_workers, batch_size)
+
+            writer.flush()
+            if self.ledger:
+                print(f"{city} {save_day}：任务状态 {self.ledger.summary(city, save_day)}")
+            return writer.written
+
+    def process_tasks(self, vehicle_ids, start_time, end_time, writer, save_day, fetch_mode, concurrency,
+                      match_workers, batch_size):
+        """
+        获取并匹配一批车辆，结果交给批量写入器
+        """
+        if not vehicle_ids:
+            return
+
+        if fetch_mode == 'pipeline':
+            self.run_pipeline(vehicle_ids, start_time, end_time, writer, concurrency, match_workers)
+            return
+
+        task_queue = queue.Queue()
+        # 有界队列，写入跟不上时匹配线程等待，避免结果在内存中堆积
+        result_queue = queue.Queue(maxsize=batch_size * 2)
+        threads = []
+
+        saver = threading.Thread(target=self.result_saver, args=(result_queue, writer, save_day))
+        saver.start()
+
+        if fetch_mode == 'async':
+            asyncio.run(self.fetch_and_match_async(vehicle_ids, start_time, end_time, result_queue, concurrency))
+        else:
+            # 创建工作线程
+            for _ in range(concurrency):  # 线程数量
+                thread = threading.Thread(target=self.worker, args=(task_queue, result_queue))
+                thread.start()
+                threads.append(thread)
+
+            # 向队列中添加任务
+            for vin in vehicle_ids:
+                task_queue.put((vin, start_time, end_time))
+
+            # 停止信号
+            for _ in range(len(threads)):
+                task_queue.put(None)
+
+            task_queue.join()
 
-        # 处理结果
-        results = []
-        while not result_queue.empty():
-            route_request= result_queue.get()
-            results.append(route_request)
-            # 数据库保存vin、匹配路线、匹配率、覆盖路线、日期
-            vin = route_request[0]
-            matched_route = route_request[1]
-            match_rate = route_request[2]
-            route_coverage = route_request[3]
-            print("存储展示：",vin,matched_route,match_rate,route_coverage,save_day)
-            db_manager.insert_match_result(vin, matched_route, match_rate, route_coverage, save_day,city)
-
-        return results
+            # 等待所有任务完成
+            for thread in threads:
+                thread.join()
 
+        # 等待剩余结果写入
+        result_queue.put(None)
+        saver.join()
@@ -0,0 +1,123 @@
+import os
+import time
+import shutil
+import threading
+import numpy as np
+import pandas as pd
+
+#坐标按百万分之一度存为整数，接口返回的坐标为6位小数，读回后与直接解析的结果完全一致
+COORD_SCALE = 1e6
+#保留期默认天数
+DEFAULT_RETENTION_DAYS = 30
+
+
+class TrajectoryStore:
+    """
+    车辆轨迹的本地列式存储，按 城市/日期/VIN 分区保存为parquet文件。
+    获取轨迹时先读本地文件，没有时再调用接口并保存，超过保留期的文件定期清理
+    """
+    def __init__(self, root_dir, retention_days=DEFAULT_RETENTION_DAYS):
+        self.root_dir = root_dir
+        self.retention_days = retention_days
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(root_dir, exist_ok=True)
+
+    def get_path(self, city, vin, start_time, end_time):
+        # 同一天可能使用不同的时间段，文件名中包含时间段
+        file_name = f"{vin}_{start_time:%H%M%S}_{end_time:%H%M%S}.parquet"
+        return os.path.join(self.root_dir, city.lower(), f"{start_time:%Y-%m-%d}", file_name)
+
+    def load(self, city, vin, start_time, end_time):
+        """
+        读取本地轨迹，不存在或读取失败时返回None
+        """
+        path = self.get_path(city, vin, start_time, end_time)
+        if not os.path.exists(path):
+            with self.lock:
+                self.misses += 1
+            return None
+        try:
+            df = pd.read_parquet(path)
+        except Exception as e:
+            print(f"读取本地轨迹失败：{path}: {e}")
+            with self.lock:
+                self.misses += 1
+            return None
+        with self.lock:
+            self.hits += 1
+        if df['经度'].dtype.kind == 'i':
+            df['经度'] = df['经度'] / COORD_SCALE
+            df['纬度'] = df['纬度'] / COORD_SCALE
+        return df
+
+    def save(self, city, vin, start_time, end_time, vehicle_history):
+        """
+        保存轨迹，先写临时文件再替换。坐标不超过6位小数时按整数保存，否则保留原始精度
+        """
+        path = self.get_path(city, vin, start_time, end_time)
+        lng = vehicle_history['经度'].to_numpy(dtype=np.float64)
+        lat = vehicle_history['纬度'].to_numpy(dtype=np.float64)
+        scaled_lng = np.round(lng * COORD_SCALE)
+        scaled_lat = np.round(lat * COORD_SCALE)
+        if np.array_equal(scaled_lng / COORD_SCALE, lng) and np.array_equal(scaled_lat / COORD_SCALE, lat):
+            df = pd.DataFrame({'经度': scaled_lng.astype(np.int32), '纬度': scaled_lat.astype(np.int32)})
+        else:
+            df = pd.DataFrame({'经度': lng, '纬度': lat})
+
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            df.to_parquet(tmp_path, index=False)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"保存本地轨迹失败：{path}: {e}")
+
+    def get_or_fetch(self, city, vin, start_time, end_time, fetch):
+        """
+        优先读取本地轨迹，没有时调用fetch获取并保存。获取失败抛出的异常不会被保存
+        """
+        vehicle_history = self.load(city, vin, start_time, end_time)
+        if vehicle_history is None:
+            vehicle_history = fetch()
+            self.save(city, vin, start_time, end_time, vehicle_history)
+        return vehicle_history
+
+    def purge(self):
+        """
+        删除超过保留期的轨迹文件和空目录
+        :return: 删除的文件数量
+        """
+        if not self.retention_days or self.retention_days <= 0:
+            return 0
+        expire_before = time.time() - self.retention_days * 86400
+        removed = 0
+        for city in os.listdir(self.root_dir):
+            city_dir = os.path.join(self.root_dir, city)
+            if not os.path.isdir(city_dir):
+                continue
+            for day in os.listdir(city_dir):
+                day_dir = os.path.join(city_dir, day)
+                try:
+                    files = [entry for entry in os.scandir(day_dir) if entry.is_file()]
+                except OSError:
+                    continue
+                expired = [entry for entry in files if entry.stat().st_mtime < expire_before]
+                if len(expired) == len(files):
+                    shutil.rmtree(day_dir, ignore_errors=True)
+                else:
+                    for entry in expired:
+                        try:
+                            os.remove(entry.path)
+                        except OSError:
+                            pass
+                removed += len(expired)
+        if removed:
+            print(f"已清理{removed}个过期的本地轨迹文件")
+        return removed
+
+    def stats(self):
+        with self.lock:
+            return {'root_dir': self.root_dir, 'retention_days': self.retention_days,
+                    'hits': self.hits, 'misses': self.misses}
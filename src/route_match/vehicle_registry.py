@@ -0,0 +1,221 @@
+import os
+import re
+import math
+import threading
+from itertools import chain
+import pandas as pd
+
+#车辆清单中使用的列
+COLUMNS = ['VIN', '车牌', '订单号', '车型', '购车客户', '所属区域', 'city']
+#建立索引的查询字段与对应的列
+INDEX_COLUMNS = {
+    'order': '订单号',
+    'model': '车型',
+    'customer': '购车客户',
+    'region': '所属区域',
+    'city': 'city'
+}
+#模糊查询使用的列
+SEARCH_COLUMNS = ['VIN', '车牌']
+#模糊查询倒排索引的n-gram长度
+NGRAM_SIZE = 3
+#候选数量超过车辆总数的该比例时，直接扫描比合并倒排列表更快
+NGRAM_SCAN_RATIO = 0.1
+
+
+class NgramIndex:
+    """
+    字符串的n-gram倒排索引，用于子串查询。
+    索引以去重后的小写字符串为单位，车辆清单变化时只增删有变化的字符串，
+    更新时生成新的索引，正在使用的索引不会被修改
+    """
+    def __init__(self, n=NGRAM_SIZE):
+        self.n = n
+        # n-gram -> 包含该n-gram的字符串集合
+        self.postings = {}
+        self.texts = set()
+
+    def grams(self, text):
+        return {text[i:i + self.n] for i in range(len(text) - self.n + 1)}
+
+    def update(self, texts):
+        """
+        生成更新为给定字符串集合后的新索引，只复制有变化的倒排列表
+        :return: (新索引, 新增数量, 删除数量)
+        """
+        texts = set(texts)
+        added = texts - self.texts
+        removed = self.texts - texts
+        postings = dict(self.postings)
+        copied = set()
+
+        def posting_for(gram):
+            if gram not in copied:
+                copied.add(gram)
+                postings[gram] = set(postings.get(gram, ()))
+            return postings[gram]
+
+        for text in added:
+            for gram in self.grams(text):
+                posting_for(gram).add(text)
+        for text in removed:
+            for gram in self.grams(text):
+                if gram in postings:
+                    posting = posting_for(gram)
+                    posting.discard(text)
+                    if not posting:
+                        del postings[gram]
+                        copied.discard(gram)
+
+        index = NgramIndex(self.n)
+        index.postings = postings
+        index.texts = texts
+        return index, len(added), len(removed)
+
+    def search(self, keyword, max_candidates=None):
+        """
+        查询包含keyword的字符串，keyword需已转为小写
+        :param max_candidates: 候选字符串超过该数量时放弃使用索引
+        :return: 匹配的字符串集合，查询词短于n-gram或候选过多时返回None，由调用方直接扫描
+        """
+        if len(keyword) < self.n:
+            return None
+
+        postings = []
+        for gram in self.grams(keyword):
+            posting = self.postings.get(gram)
+            if not posting:
+                return set()
+            postings.append(posting)
+        postings.sort(key=len)
+        if max_candidates is not None and len(postings[0]) > max_candidates:
+            return None
+        # n-gram都包含不代表子串匹配，需要再校验一次
+        return {text for text in postings[0].intersection(*postings[1:]) if keyword in text}
+
+
+class VehicleRegistry:
+    """
+    车辆清单的内存索引，首次查询时读取Excel，之后只在文件变化时重新读取，查询时不需要任何pandas操作
+    """
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.reload_lock = threading.Lock()
+        self.mtime = None
+        # (车辆记录列表, 各字段的索引, 小写VIN/车牌 -> 下标列表, 各车辆的小写VIN和车牌, n-gram索引)，
+        # 重新加载时整体替换
+        self.snapshot = ([], {}, {}, [], NgramIndex())
+
+    @staticmethod
+    def index_key(value):
+        """
+        索引的键：订单号等数字统一为整数字符串，空值为None
+        """
+        if value is None:
+            return None
+        if isinstance(value, float):
+            if math.isnan(value):
+                return None
+            if value.is_integer():
+                value = int(value)
+        return str(value)
+
+    def reload(self, if_changed=False):
+        """
+        重新读取车辆清单并重建索引
+        :param if_changed: 为True时获取锁后再比较一次修改时间，其他线程已经加载过时不再重复读取
+        """
+        with self.reload_lock:
+            mtime = os.stat(self.file_path).st_mtime
+            if if_changed and mtime == self.mtime:
+                return
+            df = pd.read_excel(self.file_path, engine='openpyxl', usecols=COLUMNS)
+            records = df[COLUMNS].to_dict(orient='records')
+
+            indexes = {field: {} for field in INDEX_COLUMNS}
+            for position, record in enumerate(records):
+                for field, column in INDEX_COLUMNS.items():
+                    key = self.index_key(record[column])
+                    if key is not None:
+                        indexes[field].setdefault(key, []).append(position)
+
+            text_positions = {}
+            search_texts = []
+            for position, record in enumerate(records):
+                texts = [record[column].lower() for column in SEARCH_COLUMNS if isinstance(record[column], str)]
+                for text in set(texts):
+                    text_positions.setdefault(text, []).append(position)
+                # 以换行分隔，避免查询词跨VIN和车牌匹配
+                search_texts.append('\n'.join(texts))
+
+            # 只对新增和删除的VIN/车牌更新n-gram索引，新索引与其他数据一起替换
+            ngram_index, added, removed = self.snapshot[4].update(text_positions)
+            self.snapshot = (records, indexes, text_positions, search_texts, ngram_index)
+            self.mtime = mtime
+            print(f"车辆清单已加载：{len(records)}辆，模糊查询索引新增{added}条，删除{removed}条")
+
+    def refresh(self):
+        """
+        尚未加载或文件修改时间变化时重新加载。
+        尚未加载时读取失败直接抛出异常，已加载过时读取失败继续使用已加载的车辆清单
+        """
+        try:
+            mtime = os.stat(self.file_path).st_mtime
+            if mtime != self.mtime:
+                self.reload(if_changed=True)
+        except Exception as e:
+            if self.mtime is None:
+                raise
+            print(f"读取车辆清单失败，继续使用已加载的车辆清单：{e}")
+
+    def find(self, vin=None, **filters):
+        """
+        按条件查询车辆，多个条件同时满足
+        :param vin: VIN或车牌，不区分大小写的模糊匹配，包含正则表达式特殊字符时按正则表达式匹配
+        :param filters: order/model/customer/region/city 精确匹配
+        :return: 车辆记录列表，保持车辆清单中的顺序
+        """
+        self.refresh()
+        records, indexes, text_positions, search_texts, ngram_index = self.snapshot
+
+        # 各条件对应的下标列表，从最短的开始求交集
+        postings = sorted((indexes[field].get(self.index_key(value), []) for field, value in filters.items()
+                           if value is not None), key=len)
+        if not postings:
+            positions = range(len(records))
+        elif len(postings) == 1:
+            positions = postings[0]
+        else:
+            matched = set(postings[0])
+            for posting in postings[1:]:
+                matched.intersection_update(posting)
+            positions = sorted(matched)
+
+        if vin:
+            if re.escape(vin) != vin:
+                # 与原来的str.contains(case=False)一致，按正则表达式分别匹配VIN和车牌
+                pattern = re.compile(vin, re.IGNORECASE)
+                texts = {text for text in text_positions if pattern.search(text)}
+            else:
+                vin = vin.lower()
+                # 通过n-gram索引找到包含查询词的VIN/车牌，再与其他条件求交集
+                texts = ngram_index.search(vin, max_candidates=len(records) * NGRAM_SCAN_RATIO)
+            if texts is None:
+                # 查询词过短或过于常见时，直接在预先转为小写的VIN和车牌中查找
+                positions = [position for position in positions if vin in search_texts[position]]
+            else:
+                vin_positions = set(chain.from_iterable(text_positions.get(text, ()) for text in texts))
+                if isinstance(positions, range):
+                    positions = sorted(vin_positions)
+                else:
+                    positions = [position for position in positions if position in vin_positions]
+
+        return [records[position] for position in positions]
+
+    def vin_city_map(self):
+        """
+        获取VIN与所属城市的对应关系
+        """
+        self.refresh()
+        records = self.snapshot[0]
+        return {record['VIN']: record['city'] for record in records}
@@ -0,0 +1,179 @@
+import os
+import sys
+import math
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src', 'route_match'))
+
+from slope_profile import SLOPE_EPSILON, slope_profile, split_windows, window_slopes
+
+
+def get_distance(lat1, lng1, lat2, lng2):
+    """ 原PositionUtil.get_distance """
+    rad_lat1 = lat1 * math.pi / 180.0
+    rad_lat2 = lat2 * math.pi / 180.0
+    a = rad_lat1 - rad_lat2
+    b = lng1 * math.pi / 180.0 - lng2 * math.pi / 180.0
+    s = 2 * math.asin(math.sqrt(math.pow(math.sin(a / 2), 2) +
+                                math.cos(rad_lat1) * math.cos(rad_lat2) * math.pow(math.sin(b / 2), 2)))
+    s = s * 6378.137
+    return round(s * 10000) / 10000
+
+
+def get_b(x, y, j):
+    """ 原最小二乘斜率 """
+    xp = sum(x[:j]) / j
+    yp = sum(y[:j]) / j
+
+    zpp = sum((xi - xp) * (yi - yp) for xi, yi in zip(x[:j], y[:j]))
+    xxp = sum((xi - xp) ** 2 for xi in x[:j])
+
+    b = zpp / xxp if xxp != 0 else 0
+    return b
+
+
+def snapped_get_b(x, y, j):
+    """ 原最小二乘斜率，绝对值小于SLOPE_EPSILON时记为0，即新实现有意的改动 """
+    b = get_b(x, y, j)
+    return 0 if abs(b) < SLOPE_EPSILON else b
+
+
+def calculate_slope(lngArrPlot, latArrPlot, newAltitudeArr, fit=get_b):
+    """ 原SlopeCacu.calculate_slope，返回(最大坡度, 持续距离, GPS)
+    :param fit: 窗口斜率的计算函数，默认为原get_b
+    """
+    PLOT_DISTANCE = 100
+    PLOT_NUM = 4
+    miles = 0
+    sumD = 0
+    gradArr = []
+    mileArr = []
+    gpsArr = []
+    x = []
+    y = []
+    slope_result = []
+
+    for i in range(len(latArrPlot) - 1):
+        lng2 = lngArrPlot[i + 1]
+        lat2 = latArrPlot[i + 1]
+        dist1 = get_distance(latArrPlot[i], lngArrPlot[i], lat2, lng2)
+        miles += dist1
+        x.append(miles * 1000)
+        y.append(newAltitudeArr[i + 1])
+        sumD += dist1 * 1000
+
+        if sumD > PLOT_DISTANCE and len(x) > PLOT_NUM:
+            gradArr.append(fit(x, y, len(x)))
+            mileArr.append(miles)
+            gpsArr.append(f"{lng2},{lat2}")
+            x = []
+            y = []
+            sumD = 0
+
+    preMile = 0
+    gradMax = 0
+    for i in range(1, len(gradArr)):
+        if gradArr[i] * gradArr[i - 1] < 0:
+            if gradMax >= 0.03 or gradMax <= -0.03:
+                index = gradArr.index(gradMax)
+                slope_result.append((gradMax, mileArr[i - 1] - preMile, gpsArr[index]))
+            gradMax = 0
+            preMile = mileArr[i - 1]
+
+        if abs(gradMax) < abs(gradArr[i]):
+            gradMax = gradArr[i]
+
+    return slope_result
+
+
+def make_route(seed, points=2000, flat=True):
+    """
+    生成间距10至30米的折线和高程，高程由起伏路段和平坦路段交替组成，
+    平坦路段使用无法精确表示的高程值，使窗口斜率的计算误差不为0
+    :param flat: 为False时只生成起伏路段
+    """
+    rng = np.random.default_rng(seed)
+    heading = np.cumsum(rng.normal(0, 0.2, points))
+    step = rng.uniform(0.0001, 0.0003, points)
+    lng = 106.5 + np.cumsum(step * np.cos(heading))
+    lat = 29.5 + np.cumsum(step * np.sin(heading))
+
+    altitude = np.empty(points)
+    i = 0
+    level = 300.1
+    while i < points:
+        length = min(int(rng.integers(10, 60)), points - i)
+        if rng.random() < 0.4 and flat:
+            altitude[i:i + length] = level
+        else:
+            delta = np.cumsum(rng.normal(0, 2.5, length))
+            altitude[i:i + length] = np.round(level + delta, 1)
+        level = altitude[i + length - 1]
+        i += length
+    return lng.round(6), lat.round(6), altitude
+
+
+def new_calculate_slope(lng, lat, altitude):
+    step_distance = np.array([get_distance(lat[i], lng[i], lat[i + 1], lng[i + 1]) for i in range(len(lng) - 1)])
+    return slope_profile(lng, lat, altitude, step_distance)
+
+
+def assert_same_segments(expected, result):
+    assert len(result) == len(expected)
+    for (gradient, distance, gps), segment in zip(expected, result):
+        assert segment.gradient == pytest.approx(gradient, rel=1e-12)
+        assert segment.distance == distance
+        assert f"{segment.lng},{segment.lat}" == gps
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_slope_profile_matches_original(seed):
+    # 没有平坦路段时与原实现的结果一致
+    lng, lat, altitude = make_route(seed, flat=False)
+    expected = calculate_slope(lng.tolist(), lat.tolist(), altitude.tolist())
+    assert_same_segments(expected, new_calculate_slope(lng, lat, altitude))
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_slope_profile_snaps_flat_windows(seed):
+    # 有平坦路段时，与原实现的差别只在于接近0的斜率记为0
+    lng, lat, altitude = make_route(seed)
+    expected = calculate_slope(lng.tolist(), lat.tolist(), altitude.tolist(), fit=snapped_get_b)
+    assert_same_segments(expected, new_calculate_slope(lng, lat, altitude))
+
+
+def test_flat_windows_no_longer_split_segments():
+    # 有意的改动：原实现中平坦窗口的计算误差有正有负，会把坡段拆开，坡段数量多于新实现
+    lng, lat, altitude = make_route(0)
+    original = calculate_slope(lng.tolist(), lat.tolist(), altitude.tolist())
+    result = new_calculate_slope(lng, lat, altitude)
+    assert len(original) == 96
+    assert len(result) == 94
+
+
+def test_flat_windows_have_zero_slope():
+    # 间距不规则时平坦窗口的计算误差不为0，正负号不定
+    step_distance = np.random.default_rng(1).uniform(10, 30, 60).round(1)
+    x = np.cumsum(step_distance)
+    y = np.full(60, 300.1)
+    window_ends = split_windows(step_distance)
+    assert len(window_ends) > 1
+    assert np.all(window_slopes(x, y, window_ends) == 0)
+
+
+def test_flat_run_does_not_split_segment():
+    # 上坡-平坦-上坡-下坡：平坦窗口斜率为0，两段上坡合并为一个坡段
+    step_distance = np.random.default_rng(1).uniform(10, 30, 160).round(1)
+    x = np.cumsum(step_distance)
+    y = np.full(160, 300.1)
+    y[:40] = 300.1 - 0.05 * (x[39] - x[:40])
+    y[80:120] = 300.1 + 0.05 * (x[80:120] - x[79])
+    y[120:] = y[119] - 0.05 * (x[120:] - x[119])
+    lng = np.linspace(106.5, 106.6, 161)
+    lat = np.linspace(29.5, 29.6, 161)
+    altitude = np.concatenate(([y[0]], y))
+    result = slope_profile(lng, lat, altitude, step_distance / 1000)
+    assert len(result) == 1
+    assert result[0].distance > x[100] / 1000